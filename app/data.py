@@ -0,0 +1,117 @@
+"""
+Experiment data and clients shared by all the sessions of the app.
+
+Streamlit reruns main.py on every interaction, so everything that does not depend on the session is created once per
+server process here. The selection file is reloaded when it changes on disk.
+"""
+import json
+import os
+import threading
+
+import streamlit as st
+
+import repo_root  # noqa: F401
+from instrumentation import metrics
+from previews import shared_fetcher
+from responses import ResponseSink, backend_from_path
+from utils.spotify import SpotifyCatalog, client_from_credentials
+
+# Process-wide cache decorator: st.cache_resource in recent Streamlit versions, experimental_singleton before
+cache_resource = getattr(st, 'cache_resource', None) or st.experimental_singleton
+
+SELECTION_PATH = 'listening_selection_data_10.json'
+PREVIEW_CACHE_DIR = 'preview_cache'
+SPOTIFY_CACHE_PATH = 'spotify_tracks.jsonl'
+
+
+class Experiment:
+    """
+    Read-only view of a selection file (as written by the reordering notebook or utils/reorder.py), indexed by
+    playlist name
+    """
+    def __init__(self, entries, mtime=None):
+        """
+        :param entries: List of {'uris', 'playlist', 'options'} entries
+        :param mtime: Modification time of the file the entries were read from
+        """
+        self.mtime = mtime
+        self.entries = entries
+        self.by_name = {}
+        for entry in entries:
+            # the first playlist wins when two have the same name
+            self.by_name.setdefault(entry['playlist']['name'], entry)
+        self.names = list(self.by_name)
+        self.permutations = {name: {method: option['permutation'] for method, option in entry['options'].items()}
+                             for name, entry in self.by_name.items()}
+        first = next(iter(self.permutations.values()), {})
+        self.methods = list(first)
+        self.num_methods = len(first)
+        self.num_transitions = len(next(iter(first.values()), [None])) - 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"Experiment ({len(self)} playlists, methods {self.methods})"
+
+    @classmethod
+    def load(cls, path):
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as fp:
+            return cls(json.load(fp), mtime)
+
+
+class _ExperimentCache:
+    """
+    Holds the last loaded Experiment of each path, and reloads it when the file modification time changes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._experiments = {}
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        experiment = self._experiments.get(path)
+        if experiment is None or experiment.mtime != mtime:
+            with self._lock:
+                experiment = self._experiments.get(path)
+                if experiment is None or experiment.mtime != mtime:
+                    with metrics.span('experiment.load', path=path):
+                        experiment = Experiment.load(path)
+                    self._experiments[path] = experiment
+        return experiment
+
+
+@cache_resource
+def _experiment_cache():
+    return _ExperimentCache()
+
+
+def get_experiment(path=SELECTION_PATH):
+    """
+    Experiment of a selection file, shared by all the sessions. Only a stat() per rerun unless the file changed
+    """
+    return _experiment_cache().get(path)
+
+
+@cache_resource
+def get_catalog(cid, secret):
+    """
+    One batched, cached Spotify metadata client (with its pooled HTTP session) for all the sessions
+    """
+    return SpotifyCatalog(client_from_credentials(cid, secret), cache_path=SPOTIFY_CACHE_PATH)
+
+
+@cache_resource
+def get_sink(results_path):
+    """
+    One S3 client and one background writer for all the sessions
+    """
+    return ResponseSink(backend_from_path(results_path))
+
+
+def get_fetcher():
+    """
+    Preview fetcher shared by all the sessions
+    """
+    return shared_fetcher(PREVIEW_CACHE_DIR)
@@ -0,0 +1,150 @@
+"""
+Timing spans and counters of the app hot paths.
+
+Enabled with the APP_METRICS environment variable. Every span (a timed phase of a rerun: Spotify lookups, preview
+downloads, audio rendering, response writes...) is written as a json line to APP_METRICS_LOG (stderr by default),
+tagged with the session and rerun it belongs to, and kept in memory for the p50/p95 summary of each phase. When
+disabled, span() returns a shared no-op context manager and count() returns immediately.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+import numpy as np
+
+# Durations kept per phase for the percentiles
+MAX_SAMPLES = 10000
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.metrics._record(self.name, duration, self.fields)
+        return False
+
+    def set(self, **fields):
+        """
+        Adds fields to the log line of the span, e.g. sizes known only at the end
+        """
+        self.fields.update(fields)
+
+
+class _Rerun(_Span):
+    def __exit__(self, exc_type, exc, traceback):
+        super().__exit__(exc_type, exc, traceback)
+        self.metrics._local.context = {}
+        return False
+
+
+class Metrics:
+    """
+    Process-wide spans and counters
+    """
+    def __init__(self, enabled=False, log_path=None):
+        """
+        :param enabled: Whether anything is recorded
+        :param log_path: File where the json lines are appended, stderr if None
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._durations = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+        self._counters = defaultdict(int)
+        self._log = open(log_path, 'a', buffering=1) if enabled and log_path else sys.stderr
+
+    def _context(self):
+        return getattr(self._local, 'context', {})
+
+    def _emit(self, record):
+        line = json.dumps(record)
+        with self._lock:
+            self._log.write(line + '\n')
+
+    def _record(self, name, duration, fields):
+        self._durations[name].append(duration)
+        self._emit({'time': time.time(), 'span': name, 'duration': duration, **self._context(), **fields})
+
+    def span(self, name, **fields):
+        """
+        Context manager that times a phase
+        :param name: Name of the phase, e.g. 'preview.download'
+        :param fields: Extra fields of the log line
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, fields)
+
+    def count(self, name, value=1):
+        """
+        Adds value to a counter, e.g. count('preview.bytes_served', len(content))
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += value
+
+    def rerun(self, session_id):
+        """
+        Context manager around a rerun of the script: the spans recorded in this thread inside it are tagged with
+        the session and a new rerun id, and the whole rerun is timed as the 'rerun' span
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        self._local.context = {'session': session_id, 'rerun': uuid.uuid4().hex[:12]}
+        self.count('reruns')
+        return _Rerun(self, 'rerun', {})
+
+    def summary(self):
+        """
+        Aggregates of everything recorded by the process
+        :return: Dict with the count, p50, p95 and mean duration (ms) of every phase, the counters, and the preview
+            cache hit rate
+        """
+        phases = {}
+        for name, durations in list(self._durations.items()):
+            durations = np.array(durations) * 1000
+            p50, p95 = np.percentile(durations, [50, 95])
+            phases[name] = {'count': len(durations), 'p50_ms': p50, 'p95_ms': p95, 'mean_ms': durations.mean()}
+        with self._lock:
+            counters = dict(self._counters)
+        hits = counters.get('preview.memory_hits', 0) + counters.get('preview.disk_hits', 0)
+        served = hits + counters.get('preview.downloads', 0)
+        return {'phases': phases,
+                'counters': counters,
+                'preview_hit_rate': hits / served if served else None}
+
+
+def _enabled():
+    return os.environ.get('APP_METRICS', '').lower() not in ('', '0', 'false', 'no')
+
+
+metrics = Metrics(enabled=_enabled(), log_path=os.environ.get('APP_METRICS_LOG'))
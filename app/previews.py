@@ -0,0 +1,221 @@
+"""
+Fetching of the audio previews played in the listening test.
+
+Previews are kept in an on-disk content-addressed cache (objects named by the sha256 of their bytes, plus an
+append-only uri -> sha256 index) with a process-wide in-memory LRU on top. Only the tracks missing from both are
+resolved to a preview url and downloaded, concurrently over a pooled HTTP session.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as pjoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from instrumentation import metrics
+
+# Size of the in-memory LRU shared by all the sessions of the app, a preview is around 350KB
+MEMORY_CACHE_BYTES = 256 * 2 ** 20
+# Concurrent downloads, also the size of the HTTP connection pool
+MAX_WORKERS = 10
+# Seconds to wait for the preview server (connect, read)
+TIMEOUT = (3.05, 20)
+
+
+class PreviewUnavailable(LookupError):
+    """
+    Raised when a track has no preview url
+    """
+
+
+class LRUCache:
+    """
+    Thread-safe LRU of bytes values, bounded by the total size of the values
+    """
+    def __init__(self, max_bytes=MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.n_bytes -= len(old)
+            self._items[key] = value
+            self.n_bytes += len(value)
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.n_bytes -= len(evicted)
+
+
+class PreviewStore:
+    """
+    On-disk content-addressed store: objects/<sha[:2]>/<sha>.mp3 and an index.jsonl of {uri, sha256} lines
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}
+        os.makedirs(pjoin(path, 'objects'), exist_ok=True)
+        index_path = pjoin(path, 'index.jsonl')
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._index[entry['uri']] = entry['sha256']
+
+    def __contains__(self, uri):
+        return uri in self._index
+
+    def _object_path(self, digest):
+        return pjoin(self.path, 'objects', digest[:2], digest + '.mp3')
+
+    def get(self, uri):
+        """
+        Bytes of a cached preview, or None if it is not in the store
+        """
+        digest = self._index.get(uri)
+        if digest is None:
+            return None
+        try:
+            with open(self._object_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, uri, content):
+        """
+        Adds a preview to the store. The object is written before the index line, so a crash never leaves an
+        index entry without its object
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f'{object_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, object_path)
+        with self._lock:
+            if self._index.get(uri) == digest:
+                return
+            with open(pjoin(self.path, 'index.jsonl'), 'a') as f:
+                f.write(json.dumps({'uri': uri, 'sha256': digest}) + '\n')
+            self._index[uri] = digest
+
+
+def pooled_session(pool_size=MAX_WORKERS, retries=3):
+    """
+    HTTP session that reuses up to pool_size connections per host and retries failed GETs with backoff
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET']))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class PreviewFetcher:
+    """
+    Returns the audio previews of a list of tracks, from memory, from disk or downloaded, in that order
+    """
+    def __init__(self, cache_dir, memory=None, session=None, max_workers=MAX_WORKERS):
+        """
+        :param cache_dir: Directory of the on-disk store
+        :param memory: LRUCache shared between fetchers, a new one by default
+        :param session: requests.Session used for the downloads, a pooled_session() by default
+        :param max_workers: Number of concurrent downloads
+        """
+        self.store = PreviewStore(cache_dir)
+        self.memory = memory if memory is not None else LRUCache()
+        self.session = session if session is not None else pooled_session(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='preview')
+
+    def _download(self, uri, url):
+        if not url:
+            raise PreviewUnavailable(f"Track {uri} has no preview url")
+        response = self.session.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        self.store.put(uri, response.content)
+        return response.content
+
+    def fetch(self, uris, resolver):
+        """
+        Previews of a list of tracks
+        :param uris: List of track uris
+        :param resolver: Callable that maps a list of uris to their list of preview urls (None when a track has no
+        preview). It is only called with the uris that are not cached
+        :return: List with the mp3 bytes of each uri, in the given order
+        """
+        previews = {}
+        with metrics.span('preview.cache', n=len(uris)) as span:
+            n_memory = n_disk = 0
+            for uri in uris:
+                content = self.memory.get(uri)
+                if content is not None:
+                    n_memory += 1
+                else:
+                    content = self.store.get(uri)
+                    if content is not None:
+                        n_disk += 1
+                        self.memory.put(uri, content)
+                if content is not None:
+                    previews[uri] = content
+            span.set(memory_hits=n_memory, disk_hits=n_disk)
+        metrics.count('preview.memory_hits', n_memory)
+        metrics.count('preview.disk_hits', n_disk)
+
+        missing = [uri for uri in dict.fromkeys(uris) if uri not in previews]
+        if missing:
+            urls = resolver(missing)
+            with metrics.span('preview.download', n=len(missing)) as span:
+                futures = {uri: self._executor.submit(self._download, uri, url) for uri, url in zip(missing, urls)}
+                for uri, future in futures.items():
+                    previews[uri] = future.result()
+                    self.memory.put(uri, previews[uri])
+                span.set(bytes=sum(len(previews[uri]) for uri in missing))
+            metrics.count('preview.downloads', len(missing))
+        result = [previews[uri] for uri in uris]
+        if metrics.enabled:
+            metrics.count('preview.bytes_served', sum(len(content) for content in result))
+        return result
+
+
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def shared_fetcher(cache_dir):
+    """
+    PreviewFetcher shared by all the threads of the process (Streamlit runs each session in a thread)
+    :param cache_dir: Directory of the on-disk store
+    :return: The same PreviewFetcher for every call with the same cache_dir
+    """
+    with _fetchers_lock:
+        if cache_dir not in _fetchers:
+            _fetchers[cache_dir] = PreviewFetcher(cache_dir)
+        return _fetchers[cache_dir]
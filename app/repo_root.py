@@ -0,0 +1,11 @@
+"""
+Puts the repository root on sys.path, so the app modules can import the shared utils package. Streamlit only adds
+the directory of main.py, so this module is imported before the first import of utils.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
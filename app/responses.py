@@ -0,0 +1,238 @@
+"""
+Storage of the participant responses.
+
+ResponseSink takes the responses of a submission and returns immediately: a background thread writes them to the
+backend (an S3 bucket or a local directory), retrying with backoff. Submissions that cannot be written, or that are
+still queued when the process exits, are spooled to a local directory and written when the next sink starts.
+"""
+import atexit
+import json
+import os
+import queue
+import re
+import threading
+import time
+from os.path import join as pjoin
+
+from instrumentation import metrics
+
+# Retries of a failed write before the submission is spooled
+MAX_RETRIES = 5
+# Seconds waited before the first retry, doubled on each retry
+BACKOFF = 0.5
+# Seconds the exit handler waits for the queue to drain before spooling the rest
+FLUSH_TIMEOUT = 10.
+# Directory of the submissions waiting to be written
+SPOOL_DIR = 'responses_spool'
+# Suffix of the spooled submissions claimed by a sink, followed by the pid of its process
+CLAIM_SUFFIX = '.claimed-'
+# Seconds after which the claim of a sink that did not finish (e.g. a crashed process) is taken over
+STALE_CLAIM = 3600.
+# Characters of a key that cannot be part of a file name
+UNSAFE_KEY_CHARS = re.compile(r'[/\\\x00]')
+
+
+def _safe_key(key):
+    # keys contain the username, they must not leave the directory of the backend
+    key = UNSAFE_KEY_CHARS.sub('_', key)
+    return '_' + key if key in ('', '.', '..') else key
+
+
+def _write_file(path, body):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class LocalBackend:
+    """
+    Writes every submission to a file of a local directory
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, key, body):
+        _write_file(pjoin(self.directory, key), body)
+
+
+class S3Backend:
+    """
+    Writes every submission to an object of an S3 bucket, with a single client (boto3 clients are thread safe)
+    """
+    def __init__(self, bucket, prefix='', client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+    def put(self, key, body):
+        self.client.put_object(Body=body.encode('utf-8'), Bucket=self.bucket, Key=self.prefix + key)
+
+
+def backend_from_path(path):
+    """
+    Backend of a results path: 's3://bucket/' for S3, otherwise a local directory. As in the original app, the
+    objects are written at the root of the bucket, the rest of the path is ignored
+    """
+    if path.startswith('s3://'):
+        return S3Backend(path.split('/')[2])
+    return LocalBackend(path)
+
+
+def encode_records(records):
+    """
+    jsonl body of a list of records
+    """
+    return '\n'.join(json.dumps(record, ensure_ascii=False) for record in records) + '\n'
+
+
+class ResponseSink:
+    """
+    Queue of submissions written by a background thread
+    """
+    def __init__(self, backend, spool_dir=SPOOL_DIR, max_retries=MAX_RETRIES, backoff=BACKOFF,
+                 flush_timeout=FLUSH_TIMEOUT):
+        """
+        :param backend: Object with a put(key, body) method, e.g. S3Backend or LocalBackend
+        :param spool_dir: Directory where the submissions that could not be written are kept
+        :param max_retries: Retries of a failed write
+        :param backoff: Seconds waited before the first retry, doubled on each retry
+        :param flush_timeout: Seconds the exit handler waits for pending writes
+        """
+        self.backend = backend
+        self.spool = LocalBackend(spool_dir)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.flush_timeout = flush_timeout
+        self.n_written = 0
+        self.n_spooled = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='response-sink', daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+        # Submissions spooled by a previous process, claimed so that other sinks do not write them too
+        for name in sorted(os.listdir(spool_dir)):
+            claim = self._claim(name)
+            if claim is not None:
+                key, claimed = claim
+                with open(claimed, 'r', encoding='utf-8') as f:
+                    self._queue.put((key, f.read(), claimed))
+
+    def _claim(self, name):
+        """
+        Renames a spooled submission to a name of this process, the rename fails if another sink claimed it first
+        :param name: Name of the file in the spool directory
+        :return: Key of the submission and path of the claimed file, or None if it could not be claimed
+        """
+        path = pjoin(self.spool.directory, name)
+        if name.endswith('.tmp'):
+            return None
+        key = name
+        if CLAIM_SUFFIX in name:
+            key = name.rpartition(CLAIM_SUFFIX)[0]
+            try:
+                if time.time() - os.path.getmtime(path) < STALE_CLAIM:
+                    return None
+            except FileNotFoundError:
+                return None
+        claimed = pjoin(self.spool.directory, key + CLAIM_SUFFIX + str(os.getpid()))
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        # the age of a claim counts from now
+        os.utime(claimed)
+        return key, claimed
+
+    def _release(self, key, claimed):
+        # gives back a claimed submission that could not be written, for the next sink
+        try:
+            os.replace(claimed, pjoin(self.spool.directory, key))
+        except FileNotFoundError:
+            pass
+
+    def submit(self, key, records):
+        """
+        Queues the records of a submission, without waiting for them to be written
+        :param key: Name of the file (or object) of the submission, '/' and '\\' are replaced by '_'
+        :param records: List of json serializable records, written as jsonl
+        """
+        if self._closed:
+            raise RuntimeError("The response sink is closed")
+        self._queue.put((_safe_key(key), encode_records(records), None))
+
+    def _write(self, key, body, claimed):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.span('response.write', bytes=len(body), attempt=attempt, spooled=claimed is not None):
+                    self.backend.put(key, body)
+            except Exception as e:
+                metrics.count('response.failed_writes')
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+                else:
+                    print(f"Could not write response {key}, kept in {self.spool.directory}: {e}")
+            else:
+                self.n_written += 1
+                metrics.count('response.written')
+                if claimed is not None:
+                    try:
+                        os.remove(claimed)
+                    except FileNotFoundError:
+                        pass
+                return
+        if claimed is None:
+            self.spool.put(key, body)
+            self.n_spooled += 1
+            metrics.count('response.spooled')
+        else:
+            self._release(key, claimed)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                # the thread keeps writing the next submissions
+                print(f"Could not write or spool response {item[0]}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Blocks until all the queued submissions are written (or spooled)
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Writes the pending submissions, waiting at most flush_timeout seconds. The ones still queued after it are
+        spooled, so they are written by the next sink
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join(self.flush_timeout)
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                continue
+            if item[2] is None:
+                self.spool.put(item[0], item[1])
+                self.n_spooled += 1
+            else:
+                self._release(item[0], item[2])
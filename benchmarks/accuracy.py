@@ -0,0 +1,123 @@
+"""
+Accuracy of the single precision (complex64) path of tivlib against the double precision one, on a corpus of HPCPs.
+
+Compares the decisions, not only the values: the key of every track (TIVCollection.keys) and the best pitch shift
+of every pair (compatibility_matrix with best_shift) for a sample of query tracks against the whole corpus. A
+different decision is only accepted when the double precision scores of both choices are closer than the tolerance,
+i.e. a tie that float32 rounding can flip. It also checks the keys estimated from the corpus HPCPs against the keys of
+spoty_hfeats.json, which fails when the pitch reference of the HPCPs is wrong. The exit status is 1 if there is any
+other difference or the keys do not agree:
+
+    python -m benchmarks.accuracy                          # spoty_hpcps.npy and spoty_hfeats.json
+    python -m benchmarks.accuracy --hpcps other_hpcps.npy --hfeats other_hfeats.json --queries 2000
+"""
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from tivlib import TIV, TIVCollection, compatibility_matrix, tiv_vectors
+from utils.distances import HPCP_REFERENCE
+
+# Differences of double precision scores below this are ties
+TOLERANCE = 1e-5
+# Fraction of the corpus whose estimated key must match spoty_hfeats.json (about 2/3 with the right reference, under
+# 1% with a wrong one)
+MIN_KEY_AGREEMENT = 0.5
+# Pitch class of the natural notes, to read the key names of spoty_hfeats.json
+NATURALS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def key_code(name):
+    """
+    TIV key code (0-11 major, 12-23 minor, from C) of a key name of spoty_hfeats.json, e.g. 'C#major' or 'Abminor'
+    """
+    root, mode = name[:-5], name[-5:]
+    pitch_class = (NATURALS[root[0]] + root.count('#') - root.count('b')) % 12
+    return pitch_class + (12 if mode == 'minor' else 0)
+
+
+def key_agreement(hpcps, keys, reference=HPCP_REFERENCE):
+    """
+    Agreement of the keys estimated by TIVCollection.keys with reference keys
+    :param hpcps: Nx12 HPCPs
+    :param keys: N key names, e.g. the 'key' field of spoty_hfeats.json
+    :param reference: Pitch class of the first bin of the HPCPs
+    :return: A tuple with the fraction of the same keys and the fraction of the same tonics
+    """
+    codes = TIVCollection.from_pcp(hpcps.T).keys(reference=reference)[0][0]
+    expected = np.array([key_code(key) for key in keys])
+    return float(np.mean(codes == expected)), float(np.mean(codes % 12 == expected % 12))
+
+
+def key_differences(hpcps, tolerance=TOLERANCE):
+    """
+    Tracks whose key differs between complex128 and complex64
+    :return: A tuple with the number of different keys and the number of them that are not ties
+    """
+    double = TIVCollection.from_pcp(hpcps.T)
+    single = TIVCollection.from_pcp(hpcps.T, dtype=np.complex64)
+    codes, _ = double.keys()
+    single_codes, _ = single.keys()
+    different = np.flatnonzero(codes[0] != single_codes[0])
+    if not len(different):
+        return 0, 0
+    # Same distance as TIVCollection.keys, in double precision, of both keys
+    profiles, alpha = double.get_key_profiles()
+    vectors = double.vectors[0, different]
+    distances = np.sum(np.abs(profiles) ** 2, axis=1) - 2 * alpha * np.real(vectors @ profiles.conj().T)
+    rows = np.arange(len(different))
+    gaps = distances[rows, single_codes[0, different]] - distances[rows, codes[0, different]]
+    return len(different), int(np.sum(gaps > tolerance))
+
+
+def shift_differences(queries, hpcps, tolerance=TOLERANCE):
+    """
+    Pairs whose best pitch shift differs between complex128 and complex64
+    :return: A tuple with the number of pairs, the number of different shifts, the number of them that are not ties
+        and the largest absolute difference of the compatibilities at the best shift
+    """
+    double = compatibility_matrix(queries, hpcps, best_shift=True)
+    single = compatibility_matrix(queries, hpcps, best_shift=True, dtype=np.complex64)
+    rows, columns = np.nonzero(double[1] != single[1])
+    max_error = float(np.max(np.abs(double[2] - single[2])))
+    if not len(rows):
+        return double[1].size, 0, 0, max_error
+    # Double precision compatibility of each different pair at the shift chosen in single precision
+    vectors_a = tiv_vectors(queries[rows])
+    vectors_b = tiv_vectors(hpcps[columns]) * TIV.rotations[single[1][rows, columns] % 12]
+    norm_weights = np.linalg.norm(TIV.weights)
+    relatedness = np.linalg.norm(vectors_a - vectors_b, axis=1) / (norm_weights * 2)
+    dissonance = 1 - np.linalg.norm(vectors_a + vectors_b, axis=1) / (norm_weights * 2)
+    gaps = relatedness * dissonance - double[2][rows, columns]
+    return double[1].size, len(rows), int(np.sum(gaps > tolerance)), max_error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hpcps', default='spoty_hpcps.npy', help='Nx12 HPCPs')
+    parser.add_argument('--hfeats', default='spoty_hfeats.json', help='Features with the key of each HPCP, in order')
+    parser.add_argument('--queries', type=int, default=500, help='Query tracks compared with the whole corpus')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Score differences that are ties')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sample of queries')
+    args = parser.parse_args(argv)
+
+    hpcps = np.load(args.hpcps)
+    with open(args.hfeats, 'r') as f:
+        keys = [features['key'] for features in json.load(f).values()]
+    same_keys, same_tonics = key_agreement(hpcps, keys)
+    print(f"corpus keys: {same_keys:.1%} of the tracks match {args.hfeats}, {same_tonics:.1%} by tonic")
+    n_keys, key_errors = key_differences(hpcps, args.tolerance)
+    print(f"keys: {n_keys} of {len(hpcps)} tracks differ, {key_errors} beyond ties")
+
+    rng = np.random.default_rng(args.seed)
+    queries = hpcps[rng.choice(len(hpcps), size=min(args.queries, len(hpcps)), replace=False)]
+    n_pairs, n_shifts, shift_errors, max_error = shift_differences(queries, hpcps, args.tolerance)
+    print(f"best shifts: {n_shifts} of {n_pairs} pairs differ, {shift_errors} beyond ties, "
+          f"max compatibility error {max_error:.2e}")
+    return 1 if key_errors or shift_errors or same_keys < MIN_KEY_AGREEMENT else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
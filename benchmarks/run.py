@@ -0,0 +1,261 @@
+"""
+Benchmarks of the tivlib and harmonicity hot paths on synthetic corpora of HPCPs shaped like spoty_hpcps.npy.
+
+Every case is timed (best of several runs) and its peak memory is measured with tracemalloc at each corpus size.
+The results are compared with a saved baseline and the cases that got slower or use more memory than the threshold
+are reported (the exit status is 1 if there is any):
+
+    python -m benchmarks.run                         # run everything and compare with benchmarks/baseline.json
+    python -m benchmarks.run --save                  # run everything and save the results as the baseline
+    python -m benchmarks.run --sizes 10 100 --cases TIV.from_pcp ph_harmon
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from os.path import join as pjoin
+
+import numpy as np
+
+from tivlib import TIV, TIVCollection, compatibility_matrix
+from utils.distances import KEY_NAMES, METHODS, TrackFeatures, distance_matrix, top_pitch_classes
+from utils.ph_harm import mask_to_chord, milne_pc_spectrum, ph_harmon, ph_harmon_pitch_sets, ph_table
+
+# Corpus sizes, the largest one is the size of spoty_hpcps.npy
+SIZES = [10, 100, 1000, 33774]
+DEFAULT_BASELINE = pjoin(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Relative increase of time or peak memory reported as a regression
+THRESHOLD = 0.25
+# Absolute increases below these are noise (seconds, bytes), e.g. on the smallest corpora
+TOLERANCE = {'time': 1e-4, 'peak': 2 ** 20}
+# Timing: runs are repeated until MIN_TIME seconds are spent, at most MAX_REPEATS times
+MIN_TIME = 0.2
+MAX_REPEATS = 20
+
+CASES = {}
+
+
+def synthetic_hpcps(n, seed=0):
+    """
+    Random HPCPs with the range and distribution of spoty_hpcps.npy (non negative, mean ~5.4, a few peaks ~10)
+    :param n: Number of HPCPs
+    :param seed: Seed of the generator
+    :return: Nx12 float32 array
+    """
+    rng = np.random.default_rng(seed)
+    return rng.gamma(2., 2.7, size=(n, 12)).astype(np.float32)
+
+
+def case(name, max_size=None):
+    """
+    Registers a benchmark case. The decorated function takes the HPCPs of the corpus and returns the function that
+    is measured, so its setup is not measured
+    :param name: Name of the case
+    :param max_size: Largest corpus size the case is run at, for the cases that are quadratic or one call per track
+    """
+    def register(setup):
+        CASES[name] = (max_size, setup)
+        return setup
+    return register
+
+
+@case('TIV.from_pcp')
+def _tiv_from_pcp(hpcps):
+    return lambda: [TIV.from_pcp(pcp) for pcp in hpcps]
+
+
+@case('TIVCollection.from_pcp')
+def _collection_from_pcp(hpcps):
+    return lambda: TIVCollection.from_pcp(hpcps.T)
+
+
+@case('TIVCollection.from_pcp.complex64')
+def _collection_from_pcp_single(hpcps):
+    return lambda: TIVCollection.from_pcp(hpcps.T, dtype=np.complex64)
+
+
+@case('TIVCollection.get_12_transposes')
+def _get_12_transposes(hpcps):
+    collection = TIVCollection.from_pcp(hpcps[:, :, np.newaxis])
+    return collection.get_12_transposes
+
+
+@case('TIV.get_max_compatibility')
+def _tiv_get_max_compatibility(hpcps):
+    query = TIV.from_pcp(hpcps[0])
+    tivs = [TIV.from_pcp(pcp) for pcp in hpcps]
+    return lambda: [query.get_max_compatibility(tiv) for tiv in tivs]
+
+
+@case('TIVCollection.get_max_compatibility')
+def _collection_get_max_compatibility(hpcps):
+    query = TIVCollection.from_pcp(hpcps[:1, :, np.newaxis])
+    collection = TIVCollection.from_pcp(hpcps[:, :, np.newaxis])
+    return lambda: query.get_max_compatibility(collection)
+
+
+@case('TIV.key')
+def _tiv_key(hpcps):
+    tivs = [TIV.from_pcp(pcp) for pcp in hpcps]
+    return lambda: [tiv.key() for tiv in tivs]
+
+
+@case('TIVCollection.keys')
+def _collection_keys(hpcps):
+    collection = TIVCollection.from_pcp(hpcps.T)
+    return collection.keys
+
+
+@case('TIVCollection.keys.complex64')
+def _collection_keys_single(hpcps):
+    collection = TIVCollection.from_pcp(hpcps.T, dtype=np.complex64)
+    return collection.keys
+
+
+@case('compatibility_matrix.best_shift', max_size=1000)
+def _compatibility_matrix(hpcps):
+    return lambda: compatibility_matrix(hpcps, best_shift=True)
+
+
+@case('compatibility_matrix.best_shift.complex64', max_size=1000)
+def _compatibility_matrix_single(hpcps):
+    return lambda: compatibility_matrix(hpcps, best_shift=True, dtype=np.complex64)
+
+
+@case('ph_harmon', max_size=1000)
+def _ph_harmon(hpcps):
+    # As the original comp_ph did for every pair: milne spectrum of the top-3 pitch classes, then its harmonicity
+    chords = [mask_to_chord(mask) for mask in top_pitch_classes(hpcps)]
+    return lambda: [ph_harmon(milne_pc_spectrum(chord)) for chord in chords]
+
+
+@case('ph_harmon_pitch_sets')
+def _ph_harmon_pitch_sets(hpcps):
+    chords = [mask_to_chord(mask) for mask in top_pitch_classes(hpcps)]
+    return lambda: ph_harmon_pitch_sets(chords)
+
+
+def _features(hpcps):
+    rng = np.random.default_rng(len(hpcps))
+    keys = rng.integers(len(KEY_NAMES), size=len(hpcps)).astype(np.int8)
+    return TrackFeatures([f'spotify:track:{i}' for i in range(len(hpcps))], keys, hpcps)
+
+
+def _distance_case(method):
+    def setup(hpcps):
+        if method == 'ph':
+            ph_table()  # built once, outside of the measure
+        features = _features(hpcps)
+        return lambda: distance_matrix(method, features)
+    return setup
+
+
+for _method in METHODS:
+    case(f'distance_matrix.{_method}', max_size=1000)(_distance_case(_method))
+
+
+def measure(function):
+    """
+    Best time and peak memory of a function
+    :return: Dict with the time in seconds and the peak of traced memory in bytes
+    """
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    while len(times) < MAX_REPEATS and sum(times) < MIN_TIME:
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'time': min(times), 'peak': peak}
+
+
+def run(cases=None, sizes=None, log=None):
+    """
+    Runs the benchmark cases
+    :param cases: Names of the cases, all of them by default
+    :param sizes: Corpus sizes, SIZES by default
+    :param log: Optional function called with every (case, size, result)
+    :return: Dict of results by case and size (as a string)
+    """
+    results = {}
+    for name in cases or CASES:
+        max_size, setup = CASES[name]
+        for size in sizes or SIZES:
+            if max_size is not None and size > max_size:
+                continue
+            result = measure(setup(synthetic_hpcps(size)))
+            results.setdefault(name, {})[str(size)] = result
+            if log is not None:
+                log(name, size, result)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Cases whose time or peak memory grew more than threshold with respect to the baseline
+    :return: List of (case, size, metric, baseline value, new value)
+    """
+    regressions = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            reference = baseline.get(name, {}).get(size)
+            if reference is None:
+                continue
+            for metric in ('time', 'peak'):
+                if (result[metric] > reference[metric] * (1 + threshold)
+                        and result[metric] - reference[metric] > TOLERANCE[metric]):
+                    regressions.append((name, size, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def _print_result(name, size, result):
+    print(f"{name:<44} {size:>6} {result['time'] * 1000:>12.3f} ms {result['peak'] / 2 ** 20:>10.2f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', default=None, choices=list(CASES), help='Cases to run')
+    parser.add_argument('--sizes', nargs='+', type=int, default=None, help='Corpus sizes')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Json with the baseline results')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Relative increase reported')
+    args = parser.parse_args(argv)
+
+    print(f"{'case':<44} {'size':>6} {'time':>15} {'peak memory':>13}")
+    results = run(args.cases, args.sizes, log=_print_result)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)['results']
+        for name, sizes in results.items():
+            baseline.setdefault(name, {}).update(sizes)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'numpy': np.__version__, 'results': baseline}, f, indent=1)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create it")
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for name, size, metric, reference, value in regressions:
+        print(f"REGRESSION {name} at {size} tracks: {metric} {reference:.4g} -> {value:.4g} "
+              f"(+{100 * (value / reference - 1):.0f}%)")
+    if not regressions:
+        print(f"No regressions above {100 * args.threshold:.0f}%")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
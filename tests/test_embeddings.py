@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+from utils.embeddings import EmbeddingStore
+
+
+def test_append_keeps_computed_rows(tmp_path):
+    path = str(tmp_path / 'embeddings')
+    store = EmbeddingStore.create(path, ['a', 'b'], size=4)
+    store.embeddings[0] = 1.
+    store.done[0] = True
+    store.flush()
+
+    store.append(['b', 'c', 'long:uri:d', 'c'])
+    assert list(store.uris) == ['a', 'b', 'c', 'long:uri:d']
+    assert store.embeddings.shape == (4, 4) and store.meta['n_tracks'] == 4
+    assert np.all(store['a'] == 1.) and np.all(np.isnan(store.gather(['b', 'c', 'long:uri:d'])))
+    assert list(store.done) == [True, False, False, False]
+
+    reopened = EmbeddingStore(path)
+    assert len(reopened) == 4 and reopened.row('long:uri:d') == 3
+    assert not any(name.endswith('.tmp.npy') or name.endswith('.tmp') for name in os.listdir(path))
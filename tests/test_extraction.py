@@ -0,0 +1,48 @@
+import numpy as np
+
+import utils.extraction as extraction
+
+
+class FailingKey:
+    """
+    Stand-in for essentia.standard that loads any file and fails in Key, after the HPCPs
+    """
+    def MonoLoader(self, filename, sampleRate):
+        return lambda: np.zeros(2 * extraction.FRAME_SIZE, dtype=np.float32)
+
+    def Windowing(self, **kwargs):
+        return lambda frame: frame
+
+    def Spectrum(self, **kwargs):
+        return lambda frame: frame
+
+    def SpectralPeaks(self, **kwargs):
+        return lambda spectrum: (np.zeros(1), np.zeros(1))
+
+    def HPCP(self, **kwargs):
+        return lambda frequencies, magnitudes: np.zeros(12, dtype=np.float32)
+
+    def FrameGenerator(self, audio, frameSize, hopSize, startFromZero):
+        return [audio[:frameSize]]
+
+    def Key(self, **kwargs):
+        def key(hpcp):
+            raise RuntimeError('Key: empty HPCP')
+        return key
+
+
+def test_analysis_errors_fail_the_track(monkeypatch, capsys):
+    monkeypatch.setattr(extraction, 'es', FailingKey())
+    assert extraction.extract_track('preview.mp3') is None
+    assert 'preview.mp3' in capsys.readouterr().err
+
+
+def test_failed_tracks_are_recorded(tmp_path):
+    store = extraction.ExtractionStore(str(tmp_path))
+    store.append_failed('spotify:track:a')
+    with open(tmp_path / 'failed.txt', 'a') as f:
+        f.write('spotify:track:partial')
+    reopened = extraction.ExtractionStore(str(tmp_path))
+    reopened.append_failed('spotify:track:b')
+    failed = extraction.ExtractionStore(str(tmp_path)).failed
+    assert failed == {'spotify:track:a', 'spotify:track:partial', 'spotify:track:b'}
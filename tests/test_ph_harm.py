@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from utils.ph_harm import N_PC_SETS, chord_to_mask, milne_pc_spectrum, ph_harmon, ph_harmon_chords, ph_harmon_masks
+
+CHORDS = [[0, 4, 7], [0, 3, 7], [2, 5, 9, 11]]
+
+
+@pytest.fixture(scope='module')
+def expected():
+    return np.array([ph_harmon(milne_pc_spectrum(chord)) for chord in CHORDS])
+
+
+def test_chord_layouts(expected):
+    masks = np.array([chord_to_mask(chord) for chord in CHORDS])
+    membership = ((masks[:, np.newaxis] >> np.arange(12)) & 1).astype(bool)
+    assert np.allclose(ph_harmon_chords(CHORDS), expected)
+    assert np.allclose(ph_harmon_chords(membership), expected)
+    assert np.allclose(ph_harmon_masks(masks), expected)
+
+
+def test_integer_arrays_are_pitch_classes(expected):
+    # A 2-D integer array holds pitch classes, one chord per row, never bitmasks
+    single = ph_harmon_chords(np.array([[0, 4, 7]]))
+    assert single.shape == (1,) and np.isclose(single[0], expected[0])
+    assert np.allclose(ph_harmon_chords(np.array([[0, 4, 7], [0, 3, 7]])), expected[:2])
+
+
+@pytest.mark.parametrize('chord', [np.array([0, 4, 7]), [0, 4, 7]])
+def test_single_chord_rejected(chord):
+    with pytest.raises(ValueError):
+        ph_harmon_chords(chord)
+
+
+def test_masks_out_of_range():
+    with pytest.raises(ValueError):
+        ph_harmon_masks([N_PC_SETS])
+    with pytest.raises(TypeError):
+        ph_harmon_masks([1.5])
@@ -0,0 +1,46 @@
+import os
+from os.path import join as pjoin
+
+import pytest
+
+from previews import PreviewFetcher, PreviewUnavailable
+from utils.spotify import OfflineSpotify, SpotifyCatalog
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    """
+    Catalog of fake previews served by a local http.server, and a track without preview
+    """
+    uris = [f'spotify:track:{i:022d}' for i in range(12)]
+    contents = {uri: os.urandom(1000 + i) for i, uri in enumerate(uris)}
+    for uri, content in contents.items():
+        with open(pjoin(tmp_path, uri + '.mp3'), 'wb') as f:
+            f.write(content)
+    client = OfflineSpotify(tracks={'spotify:track:nopreview': {'preview_url': None}}, previews_dir=str(tmp_path))
+    yield SpotifyCatalog(client), contents
+    client.close()
+
+
+def test_fetch_end_to_end(catalog, tmp_path_factory):
+    catalog, contents = catalog
+    uris = list(contents)
+    cache_dir = str(tmp_path_factory.mktemp('cache'))
+    assert all(url.startswith('http://') for url in catalog.preview_urls(uris))
+
+    requested = []
+
+    def resolver(missing):
+        requested.extend(missing)
+        return catalog.preview_urls(missing)
+
+    fetcher = PreviewFetcher(cache_dir)
+    assert fetcher.fetch(uris, resolver) == [contents[uri] for uri in uris]
+    assert sorted(requested) == sorted(uris)
+    # from memory, then from disk by a new fetcher
+    requested.clear()
+    assert fetcher.fetch(uris[::-1], resolver) == [contents[uri] for uri in uris[::-1]] and not requested
+    assert PreviewFetcher(cache_dir).fetch(uris, resolver) == [contents[uri] for uri in uris] and not requested
+
+    with pytest.raises(PreviewUnavailable):
+        fetcher.fetch(['spotify:track:nopreview'], resolver)
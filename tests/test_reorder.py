@@ -0,0 +1,66 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from utils.features import FeatureStore
+from utils.reorder import MATRIX_DIR_SUFFIX, read_checkpoint, run
+
+# Methods solved in the tests, ph is left out because it builds the harmonicity table
+METHODS = ['binary', 'circle', 'tiv']
+
+
+@pytest.fixture
+def pool(tmp_path):
+    rng = np.random.default_rng(0)
+    uris = [f'spotify:track:{i}' for i in range(8)]
+    FeatureStore.write(str(tmp_path / 'features'), uris, rng.random((8, 12)), rng.integers(0, 24, 8),
+                       np.full(8, 120.), np.full(8, .5))
+    playlists = {'1': {'name': 'one', 'tracks': [{'track_uri': uri} for uri in uris[:6]]},
+                 '2': {'name': 'two', 'tracks': [{'track_uri': uri} for uri in uris[2:]]}}
+    return tmp_path, playlists
+
+
+def _run(tmp_path, playlists, **kwargs):
+    with open(tmp_path / 'playlists.json', 'w') as f:
+        json.dump(playlists, f)
+    return run(str(tmp_path / 'playlists.json'), str(tmp_path / 'features'), str(tmp_path / 'checkpoint.jsonl'),
+               str(tmp_path / 'output.json'), methods=METHODS, workers=1, **kwargs)
+
+
+def test_matrices_kept_out_of_checkpoint(pool):
+    tmp_path, playlists = pool
+    assert len(_run(tmp_path, playlists)) == 2
+    matrix_dir = str(tmp_path / 'checkpoint.jsonl') + MATRIX_DIR_SUFFIX
+    records = read_checkpoint(str(tmp_path / 'checkpoint.jsonl'))
+    assert len(records) == 6
+    for record in records.values():
+        matrix = np.load(os.path.join(matrix_dir, record['matrix']))
+        assert matrix.shape == (len(record['uris']),) * 2
+
+
+def test_incremental_replaces_matrix(pool):
+    tmp_path, playlists = pool
+    _run(tmp_path, playlists)
+    matrix_dir = str(tmp_path / 'checkpoint.jsonl') + MATRIX_DIR_SUFFIX
+    before = set(os.listdir(matrix_dir))
+
+    playlists['1']['tracks'].append({'track_uri': 'spotify:track:7'})
+    _run(tmp_path, playlists, incremental=True)
+    after = set(os.listdir(matrix_dir))
+    assert len(after) == len(before) == 6
+    assert len(before - after) == 3
+    records = read_checkpoint(str(tmp_path / 'checkpoint.jsonl'))
+    assert all(len(records[('1', method)]['permutation']) == 7 for method in METHODS)
+
+
+def test_failed_job_does_not_stop_run(pool, capsys):
+    tmp_path, playlists = pool
+    with open(tmp_path / 'playlists.json', 'w') as f:
+        json.dump(playlists, f)
+    result = run(str(tmp_path / 'playlists.json'), str(tmp_path / 'features'), str(tmp_path / 'checkpoint.jsonl'),
+                 str(tmp_path / 'output.json'), methods=['tiv', 'unknown'], workers=1)
+    assert result == []
+    assert len(read_checkpoint(str(tmp_path / 'checkpoint.jsonl'))) == 2
+    assert 'unknown failed' in capsys.readouterr().err
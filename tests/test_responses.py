@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from responses import CLAIM_SUFFIX, LocalBackend, ResponseSink, backend_from_path
+
+
+class FailingBackend:
+    def put(self, key, body):
+        raise OSError('unreachable')
+
+
+def test_key_stays_in_directory(tmp_path):
+    sink = ResponseSink(LocalBackend(str(tmp_path / 'out')), spool_dir=str(tmp_path / 'spool'))
+    sink.submit('2024-01-01_playlist_../a/b', [{'method': 'tiv'}])
+    sink.flush()
+    assert os.listdir(tmp_path / 'out') == ['2024-01-01_playlist_.._a_b']
+
+
+def test_worker_survives_errors(tmp_path):
+    sink = ResponseSink(FailingBackend(), spool_dir=str(tmp_path / 'spool'), max_retries=0)
+    sink.spool = None
+    sink.submit('first', [1])
+    sink.flush()
+    assert sink._worker.is_alive()
+
+
+def test_spool_is_replayed_once(tmp_path):
+    spool_dir = str(tmp_path / 'spool')
+    failing = ResponseSink(FailingBackend(), spool_dir=spool_dir, max_retries=0)
+    failing.submit('key', [{'method': 'tiv'}])
+    failing.flush()
+    assert os.listdir(spool_dir) == ['key']
+
+    backend = LocalBackend(str(tmp_path / 'out'))
+    first = ResponseSink(backend, spool_dir=spool_dir)
+    second = ResponseSink(backend, spool_dir=spool_dir)
+    first.flush()
+    second.flush()
+    assert first.n_written + second.n_written == 1
+    assert os.listdir(spool_dir) == []
+    assert os.listdir(tmp_path / 'out') == ['key']
+
+
+def test_failed_replay_is_released(tmp_path):
+    spool_dir = str(tmp_path / 'spool')
+    LocalBackend(spool_dir).put('key', '{}\n')
+    sink = ResponseSink(FailingBackend(), spool_dir=spool_dir, max_retries=0)
+    sink.flush()
+    assert os.listdir(spool_dir) == ['key']
+    assert not any(CLAIM_SUFFIX in name for name in os.listdir(spool_dir))
+
+
+def test_s3_keys_at_bucket_root():
+    pytest.importorskip('boto3')
+    backend = backend_from_path('s3://bucket/responses')
+    assert (backend.bucket, backend.prefix) == ('bucket', '')
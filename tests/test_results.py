@@ -0,0 +1,55 @@
+import json
+import os
+from os.path import join as pjoin
+
+import pytest
+
+from utils.results import ResultsTable
+
+
+@pytest.fixture
+def write(tmp_path):
+    def write(name, ratings):
+        with open(pjoin(tmp_path, name), 'w') as f:
+            for k, (method, harmonicity) in enumerate(ratings):
+                f.write(json.dumps({'method': method, 'transition_idx': k, 'transition': 'AB', 'user': name,
+                                    'playlist': 'p', 'harmonicity': harmonicity}) + '\n')
+    return write
+
+
+def test_removed_submissions_are_dropped(tmp_path, write):
+    table = ResultsTable()
+    write('a.jsonl', [('tiv', 'bad'), ('tiv', 'good'), ('ph', 'good')])
+    write('b.jsonl', [('tiv', 'bad'), ('ph', 'bad')])
+    assert table.update(str(tmp_path)) == 2 and len(table) == 5
+
+    os.remove(pjoin(tmp_path, 'b.jsonl'))
+    assert table.update(str(tmp_path)) == 1 and len(table) == 3
+    assert list(table.manifest) == ['a.jsonl']
+    rates = {row['method']: row for row in table.inharmonic_rates(n_boot=10, seed=0)}
+    assert (rates['tiv']['bad'], rates['tiv']['transitions']) == (1, 2)
+    assert table.update(str(tmp_path)) == 0
+
+
+def test_empty_source(tmp_path):
+    table = ResultsTable.load(pjoin(tmp_path, 'results.npz'))
+    assert table.update(str(tmp_path)) == 0 and len(table) == 0
+    assert table.inharmonic_rates() == [] and table.inharmonic_rates(('method', 'playlist')) == []
+
+
+def test_rates_after_save_and_rewrite(tmp_path, write):
+    source = tmp_path / 'source'
+    source.mkdir()
+    table_path = pjoin(tmp_path, 'results.npz')
+    table = ResultsTable.load(table_path)
+    write('source/a.jsonl', [('tiv', 'bad'), ('tiv', 'good'), ('ph', 'good')])
+    write('source/b.jsonl', [('tiv', 'bad'), ('ph', 'bad')])
+    assert table.update(str(source)) == 2 and len(table) == 5
+    table.save(table_path)
+    rates = {row['method']: row for row in ResultsTable.load(table_path).inharmonic_rates(n_boot=100, seed=0)}
+    assert (rates['tiv']['bad'], rates['tiv']['transitions']) == (2, 3)
+    assert (rates['ph']['bad'], rates['ph']['transitions']) == (1, 2)
+    assert all(row['low'] <= row['rate'] <= row['high'] for row in rates.values())
+
+    write('source/b.jsonl', [('ph', 'good')])
+    assert table.update(str(source)) == 1 and len(table) == 4
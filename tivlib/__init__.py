@@ -3,6 +3,7 @@
 # original author and source are credited.
 # Released under MIT License.
 
-from .version import __version__
+from .compatibility import *
+from .search import *
 from .tiv import *
-
+from .version import __version__
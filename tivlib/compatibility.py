@@ -0,0 +1,193 @@
+# Copyright (c) 2019 Antonio Ramires, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+import numpy as np
+
+from .tiv import TIV
+
+__all__ = ['tiv_vectors', 'compatibility_matrix', 'transition_compatibility', 'transition_matrix']
+
+# Approximate size in bytes of the per-chunk work arrays of compatibility_matrix
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def tiv_vectors(pcps, dtype=None):
+    """
+    Get the TIV vectors of many pcps at once, exactly as TIV.from_pcp computes them one by one
+    :param pcps: Nx12 array containing N pcps
+    :param dtype: Complex dtype of the vectors, TIV.default_dtype by default
+    :return: Nx6 complex array containing the N TIV vectors
+    """
+    constants = TIV.constants(dtype)
+    pcps = np.atleast_2d(np.asarray(pcps, dtype=constants['real']))
+    if pcps.ndim != 2 or pcps.shape[1] != 12:
+        raise TypeError("Vector is not compatible with PCP")
+    fft = np.fft.rfft(pcps, n=12, axis=1)
+    energy = fft[:, :1]
+    vector = fft[:, 1:7]
+    # TIV.from_pcp only normalises the vector when the energy is not zero
+    vector = np.divide(vector, energy, out=vector.copy(), where=energy != 0)
+    return vector * constants['weights']
+
+
+def _split(vectors):
+    """
+    Real representation of complex vectors, so Re<a, b> becomes a real dot product
+    :param vectors: ...x6 complex array
+    :return: ...x12 real array
+    """
+    return np.concatenate((vectors.real, vectors.imag), axis=-1)
+
+
+def _small_scale_compatibility(sq_norms, gram, norm_weights):
+    """
+    Small scale compatibility written in terms of the Gram matrix, see TIV.small_scale_compatibility.
+    |a - b|^2 = |a|^2 + |b|^2 - 2 Re<a, b> and |a + b|^2 = |a|^2 + |b|^2 + 2 Re<a, b>
+    :param sq_norms: |a|^2 + |b|^2 for every pair
+    :param gram: Re<a, b> for every pair
+    :param norm_weights: Norm of the TIV weights, as a python float so single precision inputs are not upcast
+    :return: Small scale compatibility for every pair
+    """
+    relatedness_norm = np.sqrt(np.maximum(sq_norms - 2 * gram, 0)) / (norm_weights * 2)
+    dissonance_norm = 1 - np.sqrt(np.maximum(sq_norms + 2 * gram, 0)) / (norm_weights * 2)
+    return dissonance_norm * relatedness_norm
+
+
+def compatibility_matrix(pcps, other=None, best_shift=False, chunk_size=None, dtype=None):
+    """
+    Small scale compatibility between all pairs of pcps, equivalent to calling
+    TIV.from_pcp(pcps[i]).small_scale_compatibility(TIV.from_pcp(other[j])) for every i, j.
+    The rows are processed in chunks so the work memory stays bounded for large corpora.
+    :param pcps: Nx12 array containing N pcps
+    :param other: Optional Mx12 array of pcps to compare against. Defaults to pcps (NxN matrix)
+    :param best_shift: If True, also compute the pitch shift of other[j] that minimises the compatibility with
+        pcps[i], as TIV.get_max_compatibility does
+    :param chunk_size: Number of rows computed at once. By default it is chosen from CHUNK_BYTES
+    :param dtype: Complex dtype of the computation, TIV.default_dtype by default. np.complex64 halves the memory
+        and bandwidth of the work arrays, so chunks twice as large fit in CHUNK_BYTES
+    :return: NxM float32 compatibility matrix. If best_shift is True, a tuple with the compatibility matrix, the
+        NxM int8 matrix of pitch shifts in [-6, 5] and the NxM float32 compatibility at that pitch shift
+    """
+    constants = TIV.constants(dtype)
+    vectors_a = tiv_vectors(pcps, dtype)
+    vectors_b = vectors_a if other is None else tiv_vectors(other, dtype)
+    N, M = len(vectors_a), len(vectors_b)
+    norm_weights = constants['norm_weights']
+
+    split_a = _split(vectors_a)
+    split_b = _split(vectors_b)
+    sq_norms_a = np.sum(split_a ** 2, axis=1)
+    sq_norms_b = np.sum(split_b ** 2, axis=1)
+
+    n_shifts = 12 if best_shift else 1
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_BYTES // (n_shifts * max(M, 1) * constants['real'].itemsize * 4))
+
+    compatibilities = np.empty((N, M), dtype=np.float32)
+    if best_shift:
+        # 12xMx12: real representation of the 12 transpositions of every vector of other
+        split_b_transposes = _split(constants['rotations'][:, np.newaxis, :] * vectors_b)
+        shifts = np.empty((N, M), dtype=np.int8)
+        max_compatibilities = np.empty((N, M), dtype=np.float32)
+
+    for start in range(0, N, chunk_size):
+        rows = slice(start, min(start + chunk_size, N))
+        sq_norms = sq_norms_a[rows, np.newaxis] + sq_norms_b
+        if best_shift:
+            gram = np.matmul(split_a[rows], np.swapaxes(split_b_transposes, 1, 2))   # 12xCxM
+            shifted = _small_scale_compatibility(sq_norms, gram, norm_weights)
+            compatibilities[rows] = shifted[0]
+            pitch_shift = np.argmin(shifted, axis=0)
+            max_compatibilities[rows] = np.take_along_axis(shifted, pitch_shift[np.newaxis], axis=0)[0]
+            shifts[rows] = np.where(pitch_shift > 5, pitch_shift - 12, pitch_shift)
+        else:
+            gram = split_a[rows] @ split_b.T
+            compatibilities[rows] = _small_scale_compatibility(sq_norms, gram, norm_weights)
+
+    if best_shift:
+        return compatibilities, shifts, max_compatibilities
+    return compatibilities
+
+
+def _frames(stream):
+    stream = np.asarray(stream)
+    if stream.ndim != 2 or stream.shape[1] != 12:
+        raise TypeError("Frame-level pcps must be Fx12 arrays")
+    return stream
+
+
+def transition_compatibility(frames, candidates, k=None, best_shift=True, chunk_size=None, dtype=None):
+    """
+    Compatibility of the transition from a track to each of many candidate tracks: the last k frames of the track
+    are compared frame by frame with the first k frames of every candidate, and the small scale compatibilities of
+    the k frame pairs are summed, as TIVCollection.get_max_compatibility does for whole sequences.
+    All candidates and the 12 pitch shifts are computed in the same array operations.
+    :param frames: Fx12 array with the frame-level pcps of the track
+    :param candidates: Cx12 arrays (a list, or a CxFx12 array) with the frame-level pcps of the candidates. Their
+        number of frames may differ
+    :param k: Number of frames of the transition, at least 1. Defaults to the length of the shortest track
+    :param best_shift: If True, also minimise over the pitch shifts of the candidates
+    :param chunk_size: Number of candidates computed at once. By default it is chosen from CHUNK_BYTES
+    :param dtype: Complex dtype of the computation, TIV.default_dtype by default (see compatibility_matrix)
+    :return: C float32 compatibilities. If best_shift is True, a tuple with the C compatibilities at the best pitch
+        shift and the C int8 pitch shifts in [-6, 5]
+    """
+    frames = _frames(frames)
+    candidates = [_frames(candidate) for candidate in candidates]
+    C = len(candidates)
+    compatibilities = np.empty(C, dtype=np.float32)
+    shifts = np.empty(C, dtype=np.int8)
+    if not C:
+        return (compatibilities, shifts) if best_shift else compatibilities
+    shortest = min([len(frames)] + [len(candidate) for candidate in candidates])
+    if k is None:
+        k = shortest
+    elif k > shortest:
+        raise ValueError(f"k={k} is longer than the shortest track ({shortest} frames)")
+    if k < 1:
+        raise ValueError(f"A transition needs at least one frame of each track, got k={k}")
+    constants = TIV.constants(dtype)
+    norm_weights = constants['norm_weights']
+
+    tail = tiv_vectors(frames[len(frames) - k:], dtype)                                # Kx6
+    heads = tiv_vectors(np.concatenate([candidate[:k] for candidate in candidates]), dtype).reshape(C, k, 6)
+    sq_norms = np.sum(np.abs(tail) ** 2, axis=1) + np.sum(np.abs(heads) ** 2, axis=2)  # CxK
+
+    n_shifts = 12 if best_shift else 1
+    if chunk_size is None:
+        chunk_size = max(1, CHUNK_BYTES // (n_shifts * k * np.dtype(tail.dtype).itemsize * 4))
+    # Re<a, R_s b> = Re(a conj(b) . conj(R_s)) for the rotations R_s of the 12 pitch shifts
+    rotations = constants['rotations'][:n_shifts].conj().T                             # 6xS
+    for start in range(0, C, chunk_size):
+        rows = slice(start, min(start + chunk_size, C))
+        gram = np.real((tail * heads[rows].conj()) @ rotations)                        # CxKxS
+        # Same normalisation as TIVCollection.get_max_compatibility
+        relatedness_norm = np.sqrt(np.maximum(sq_norms[rows, :, np.newaxis] - 2 * gram, 0)) / (norm_weights * 2)
+        dissonance_norm = 1 - np.sqrt(np.maximum(sq_norms[rows, :, np.newaxis] + 2 * gram, 0)) / norm_weights
+        shifted = np.sum(relatedness_norm * dissonance_norm, axis=1)                  # CxS
+        pitch_shift = np.argmin(shifted, axis=1)
+        compatibilities[rows] = shifted[np.arange(len(shifted)), pitch_shift]
+        shifts[rows] = np.where(pitch_shift > 5, pitch_shift - 12, pitch_shift)
+
+    if best_shift:
+        return compatibilities, shifts
+    return compatibilities
+
+
+def transition_matrix(streams, k=None, best_shift=False, dtype=None):
+    """
+    Transition compatibility between all ordered pairs of the tracks of a playlist: entry (i, j) scores the end of
+    streams[i] followed by the beginning of streams[j]
+    :param streams: List of N Fx12 arrays with the frame-level pcps of the tracks
+    :param k: Number of frames of the transitions. Defaults to the length of the shortest track
+    :param best_shift: If True, minimise over the pitch shifts of the second track, and also return the shifts
+    :param dtype: Complex dtype of the computation, TIV.default_dtype by default
+    :return: NxN float32 matrix, and the NxN int8 pitch shifts if best_shift is True
+    """
+    results = [transition_compatibility(stream, streams, k=k, best_shift=best_shift, dtype=dtype)
+               for stream in streams]
+    if best_shift:
+        return np.stack([result[0] for result in results]), np.stack([result[1] for result in results])
+    return np.stack(results)
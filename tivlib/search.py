@@ -0,0 +1,143 @@
+# Copyright (c) 2019 Antonio Ramires, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+import numpy as np
+
+from .compatibility import _small_scale_compatibility, _split, tiv_vectors
+from .tiv import TIV
+
+__all__ = ['CompatibilityIndex']
+
+# Number of candidates with the lowest bounds evaluated first, to get the pruning threshold
+SEED_SIZE = 256
+
+
+class CompatibilityIndex:
+    """
+    Top-k search of the most compatible tracks of a corpus (lowest small scale compatibility over the 12 pitch
+    shifts of the candidates), without computing the compatibility with the whole corpus.
+    For fixed norms the compatibility decreases with g = Re<a, b>, and transposing b only rotates the phase of each
+    of its 6 coefficients, so for every pitch shift
+        g <= sum_d |a_d| |b_d|
+    Putting this bound on g in the compatibility gives a lower bound that costs a 6-d real dot product per track.
+    The tracks with the lowest bounds are evaluated first, and then only the tracks whose bound is below the k-th
+    best compatibility found, which are a small fraction of the corpus.
+    """
+    def __init__(self, magnitudes, vectors, uris=None):
+        """
+        Takes the arrays of an index, use CompatibilityIndex.build or CompatibilityIndex.load to create one
+        :param magnitudes: Nx6 magnitudes of the coefficients of the TIV vectors
+        :param vectors: Nx12x12 real representation of the 12 transpositions of every TIV vector
+        :param uris: Optional N track uris
+        """
+        self.magnitudes = magnitudes
+        self.vectors = vectors
+        self.uris = uris
+        self.sq_norms = np.sum(magnitudes.astype(np.float64) ** 2, axis=1)
+        self.norm_weights = TIV.constants()['norm_weights']
+        self._uri_rows = {uri: row for row, uri in enumerate(uris)} if uris is not None else {}
+        self.n_evaluated = 0
+
+    def __len__(self):
+        return len(self.magnitudes)
+
+    def __repr__(self):
+        return f"CompatibilityIndex ({len(self)} tracks)"
+
+    @classmethod
+    def build(cls, pcps, uris=None):
+        """
+        Index the TIVs of a corpus
+        :param pcps: Nx12 array containing N pcps
+        :param uris: Optional list of N track uris, to query by uri
+        :return: CompatibilityIndex object
+        """
+        vectors = tiv_vectors(pcps)
+        transposes = _split(TIV.rotations[np.newaxis] * vectors[:, np.newaxis])     # Nx12x12
+        if uris is not None:
+            uris = np.array([str(uri) for uri in uris])
+            if len(uris) != len(vectors):
+                raise ValueError(f"{len(uris)} uris for {len(vectors)} pcps")
+        return cls(np.abs(vectors).astype(np.float32), transposes.astype(np.float32), uris)
+
+    def save(self, path):
+        """
+        Save the index to a .npz file
+        """
+        arrays = {'magnitudes': self.magnitudes, 'vectors': self.vectors}
+        if self.uris is not None:
+            arrays['uris'] = self.uris
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save()
+        """
+        with np.load(path) as arrays:
+            return cls(arrays['magnitudes'], arrays['vectors'], arrays['uris'] if 'uris' in arrays else None)
+
+    def _evaluate(self, query, query_sq_norm, rows):
+        # Exact compatibility at the best pitch shift of the candidates
+        gram = self.vectors[rows] @ query                                             # Bx12
+        sq_norms = query_sq_norm + self.sq_norms[rows, np.newaxis]
+        shifted = _small_scale_compatibility(sq_norms, gram, self.norm_weights)
+        pitch_shift = np.argmin(shifted, axis=1)
+        self.n_evaluated += len(rows)
+        return shifted[np.arange(len(rows)), pitch_shift], pitch_shift
+
+    def _search(self, vector, k, exclude):
+        query = _split(vector).astype(np.float32)
+        query_sq_norm = float(np.sum(np.abs(vector) ** 2))
+        bounds = _small_scale_compatibility(query_sq_norm + self.sq_norms, self.magnitudes @ np.abs(vector),
+                                            self.norm_weights)
+        if exclude:
+            bounds[list(exclude)] = np.inf
+        k = min(k, len(self) - len(exclude))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int8)
+
+        seed_size = min(max(SEED_SIZE, k), len(self) - len(exclude))
+        rows = np.argpartition(bounds, seed_size - 1)[:seed_size]
+        compatibilities, shifts = self._evaluate(query, query_sq_norm, rows)
+        threshold = np.partition(compatibilities, k - 1)[k - 1]
+        # Every other track that can beat the k-th best of the seed
+        bounds[rows] = np.inf
+        others = np.flatnonzero(bounds < threshold)
+        if len(others):
+            other_compatibilities, other_shifts = self._evaluate(query, query_sq_norm, others)
+            rows = np.concatenate((rows, others))
+            compatibilities = np.concatenate((compatibilities, other_compatibilities))
+            shifts = np.concatenate((shifts, other_shifts))
+
+        order = np.lexsort((rows, compatibilities))[:k]
+        shifts = np.where(shifts[order] > 5, shifts[order] - 12, shifts[order]).astype(np.int8)
+        return rows[order], compatibilities[order].astype(np.float32), shifts
+
+    def query(self, pcp, k=10, exclude=()):
+        """
+        Get the k tracks most compatible with a pcp
+        :param pcp: 12 array with the pcp of the seed
+        :param k: Number of tracks returned
+        :param exclude: Rows of the corpus that are not returned
+        :return: A tuple with the k corpus rows, their compatibilities (ascending) and the int8 pitch shifts in
+            [-6, 5] of the tracks that give those compatibilities
+        """
+        return self._search(tiv_vectors(pcp)[0], k, set(exclude))
+
+    def query_uri(self, uri, k=10):
+        """
+        Get the k tracks most compatible with a track of the corpus, the track itself is excluded
+        :param uri: Uri of the seed track
+        :param k: Number of tracks returned
+        :return: A tuple with the k uris, their compatibilities (ascending) and the int8 pitch shifts
+        """
+        if uri not in self._uri_rows:
+            raise KeyError(uri)
+        row = self._uri_rows[uri]
+        # The real representation of the untransposed vector is the first transposition
+        split = self.vectors[row, 0].astype(np.float64)
+        rows, compatibilities, shifts = self._search(split[:6] + 1j * split[6:], k, {row})
+        return self.uris[rows], compatibilities, shifts
@@ -8,9 +8,21 @@ import matplotlib.pyplot as plt
 
 epsilon = np.finfo(float).eps
 
+# Constants of TIV.constants, by complex dtype
+_constants = {}
+
+
+def _complex_dtype(vectors):
+    # complex64 vectors are computed in single precision, anything else in double precision
+    return np.dtype(np.complex64) if getattr(vectors, 'dtype', None) == np.complex64 else np.dtype(np.complex128)
+
+
 class TIV:
 
     weights = [3, 8, 11.5, 15, 14.5, 7.5]
+    # Complex dtype of the vectors computed by from_pcp when no dtype is given. np.complex64 halves the memory of
+    # the vectors and of everything derived from them
+    default_dtype = np.complex128
     shaath_profiles = [
         [0.0507767 + 0.0969534j, 0.776472 + 0.267636j, 0.948956 + 0.251339j, -0.16524 + -0.569966j, 1.53228 + 1.09356j,
          -0.0203655 + -8.91606e-06j],
@@ -114,6 +126,13 @@ class TIV:
     key_labels = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B', 'c', 'db', 'd', 'eb', 'e', 'f', 'gb',
                   'g', 'ab', 'a', 'bb', 'b']
 
+    # Phase rotation of each of the 6 coefficients for the 12 transpositions (12x6)
+    rotations = np.exp(-2j * np.pi * np.outer(np.arange(12), np.arange(1, 7)) / 12)
+
+    # Key profiles as 24x6 complex arrays, together with the alpha scaling used to compare against them
+    key_profiles = {'temperley': (np.array(temperley_profiles), 0.55),
+                    'shaath': (np.array(shaath_profiles), 0.2)}
+
     def __init__(self, energy, vector):
         self.energy = energy
         self.vector = vector
@@ -134,12 +153,42 @@ class TIV:
         return self.vector, self.energy
 
     @classmethod
-    def from_pcp(cls, pcp):
-        fft = np.fft.rfft(pcp, n=12)
+    def constants(cls, dtype=None):
+        """
+        Weights, pitch shift rotations, key profiles and epsilon in the precision of a complex dtype, so operations on
+        vectors of that dtype are not upcast
+        :param dtype: np.complex64 or np.complex128, TIV.default_dtype by default
+        :return: Dict with the 'real' dtype, 'weights', 'norm_weights' (a python float), 'rotations' (12x6),
+            'key_profiles' (as TIV.key_profiles) and 'epsilon'
+        """
+        dtype = np.dtype(dtype or cls.default_dtype)
+        if dtype.kind != 'c':
+            raise TypeError(f"TIV vectors are complex, got dtype {dtype}")
+        if dtype not in _constants:
+            real = np.finfo(dtype).dtype
+            _constants[dtype] = {'real': real,
+                                 'weights': np.array(cls.weights, dtype=real),
+                                 'norm_weights': float(np.linalg.norm(cls.weights)),
+                                 'rotations': cls.rotations.astype(dtype),
+                                 'key_profiles': {mode: (profiles.astype(dtype), alpha)
+                                                  for mode, (profiles, alpha) in cls.key_profiles.items()},
+                                 'epsilon': np.finfo(real).eps}
+        return _constants[dtype]
+
+    @classmethod
+    def from_pcp(cls, pcp, dtype=None):
+        """
+        Get the TIV of a pcp
+        :param pcp: 12 array
+        :param dtype: Complex dtype of the vector, TIV.default_dtype by default
+        :return: TIV object
+        """
+        constants = cls.constants(dtype)
+        fft = np.fft.rfft(np.asarray(pcp, dtype=constants['real']), n=12)
         energy = fft[0]
         vector = fft[1:7]
         if energy != 0:
-            vector = ((vector / energy) * cls.weights)
+            vector = ((vector / energy) * constants['weights'])
         return cls(energy, vector)
 
     def phases(self):
@@ -152,18 +201,8 @@ class TIV:
         return TIV(self.energy+tiv2.energy, (self.energy * self.vector + tiv2.energy * tiv2.vector) / (self.energy + tiv2.energy))
 
     def key(self, mode='temperley'):
-        if mode == 'temperley':
-            profiles = self.temperley_profiles
-            alpha = 0.55
-        else:
-            profiles = self.shaath_profiles
-            alpha = 0.2
-
-        alpha_tiv = TIV(0, self.vector * alpha)
-        distance = []
-
-        for profile in profiles:
-            distance.append(TIV.euclidean(alpha_tiv, TIV(0,profile)))
+        profiles, alpha = self.get_key_profiles(mode, _complex_dtype(self.vector))
+        distance = np.linalg.norm(self.vector * alpha - profiles, axis=1)
 
         index = np.argmin(distance)
         mode = 'maj'
@@ -174,6 +213,19 @@ class TIV:
         guessed_key = self.key_labels[index]
         return guessed_key, mode
 
+    @classmethod
+    def get_key_profiles(cls, mode='temperley', dtype=np.complex128):
+        """
+        Get the key profiles used by the key estimation
+        :param mode: 'temperley' or 'shaath'. Any other value falls back to 'shaath', as in key()
+        :param dtype: Complex dtype of the profiles
+        :return: 24x6 complex array with the profiles ordered as key_labels, and the alpha scaling factor
+        """
+        key_profiles = cls.constants(dtype)['key_profiles']
+        if mode == 'temperley':
+            return key_profiles['temperley']
+        return key_profiles['shaath']
+
     def mags(self):
         return np.abs(self.vector)
 
@@ -220,13 +272,20 @@ class TIV:
         """
         if n_semitones == 0:
             return self
-        transpositions = self.get_12_transposes()
-        transposition_desired = transpositions[n_semitones]
+        rotations = self.constants(_complex_dtype(self.vector))['rotations']
+        transposed_vector = self.vector * rotations[n_semitones % 12]
         if inplace:
-            self.vector = transposition_desired.vector
-            self.energy = transposition_desired.energy
+            self.vector = transposed_vector
         else:
-            return transposition_desired
+            return TIV(self.energy, transposed_vector)
+
+
+    def get_12_transposed_vectors(self):
+        """
+        Get the vectors of all 12 possible transpositions
+        :return: 12x6 complex array, row i is the vector transposed by i semitones
+        """
+        return self.constants(_complex_dtype(self.vector))['rotations'] * self.vector
 
 
     def get_12_transposes(self):
@@ -234,16 +293,7 @@ class TIV:
         Get all 12 possible transpositions of the vector
         :return: list containing the 12 transpositions
         """
-        n = 12
-        mod = np.abs(self.vector)
-        phase = 1j * np.angle(self.vector)
-        matmul = -2j * np.pi * (np.ones((6, 12), dtype=np.float64) * np.arange(12))
-        semitones = np.arange(1, 7)
-        semitones = semitones[:, np.newaxis]
-        phase_transposition = semitones * matmul / n  # 12 phase transpositions for each interval
-        transposed_phase = phase_transposition + phase[:, np.newaxis]
-        transposed_vector = mod[:, np.newaxis] * np.exp(transposed_phase)
-        return [TIV(self.energy, transposed_vector[:, i]) for i in range(12)]
+        return [TIV(self.energy, transposed_vector) for transposed_vector in self.get_12_transposed_vectors()]
 
 
     def small_scale_compatibility(self, cand_TIV):
@@ -268,11 +318,11 @@ class TIV:
         :param tiv2: The other tiv2 to compare to.
         :return: Number of pitch shifts to apply, small scale compatibility for that pitch shift.
         """
-        tiv_tranpositions = tiv2.get_12_transposes()
-        dissonances = []
-        for tiv_tranposition in tiv_tranpositions:
-            dissonances.append(self.small_scale_compatibility(tiv_tranposition))
-        dissonances = np.array(dissonances)
+        tiv_tranpositions = tiv2.get_12_transposed_vectors()
+        norm_weights = self.constants()['norm_weights']
+        relatedness_norm = np.linalg.norm(self.vector - tiv_tranpositions, axis=1) / (norm_weights * 2)
+        dissonance_norm = 1 - (np.linalg.norm((self.vector + tiv_tranpositions) / 2, axis=1) / norm_weights)
+        dissonances = dissonance_norm * relatedness_norm
         pitch_shift = np.argmin(dissonances)
         if pitch_shift > 5:
             pitch_shift = pitch_shift - 12
@@ -299,80 +349,155 @@ class TIV:
 
 class TIVCollection(TIV):
     """
-    Class to handle lists of TIV. To handle with ease compatibility between audio excerpts
+    Class to handle lists of TIV. To handle with ease compatibility between audio excerpts.
+    The data is held as contiguous arrays, TIV objects are only created when the collection is indexed.
     """
-    def __init__(self, tivlist):
+    def __init__(self, energies, vectors, dtype=None):
         """
-        The constructor of the class. Takes a list of TIV vectors
-        :param tivlist: A list containing all the tivs of an audio
+        The constructor of the class. Takes the energies and vectors of S sequences of N TIVs
+        :param energies: SxN array containing the energy of each TIV
+        :param vectors: SxNx6 complex array containing the vector of each TIV
+        :param dtype: Complex dtype the energies and vectors are converted to. By default they are kept as given.
+            The operations of the collection keep the precision of its vectors (np.complex64 or np.complex128)
         """
-        if not all([isinstance(element, list) for element in tivlist]):
-            tivlist = [tivlist]
-
-        if not all([ [isinstance(tivi, TIV) for tivi in innertivlist] for innertivlist in tivlist] ):
-            raise TypeError("Some element in the list is not a TIV object")
-
-
-        self.tivlist = tivlist  # Nested list of TIV sequences
-        self.weights = tivlist[0][0].weights
-        self.energies = np.array([ [i.energy for i in innertivlist] for innertivlist in tivlist] )
-        self.vectors =  np.array([ [i.vector for i in innertivlist] for innertivlist in tivlist] )
+        energies = np.asarray(energies, dtype=dtype)
+        vectors = np.asarray(vectors, dtype=dtype)
+        if energies.ndim == 1:
+            energies = energies[np.newaxis]
+        if vectors.ndim == 2:
+            vectors = vectors[np.newaxis]
+        if vectors.shape != energies.shape + (6,):
+            raise ValueError("Energies and vectors shapes do not match")
+
+        self.energies = energies
+        self.vectors = vectors
         S, N = self.energies.shape[0], self.energies.shape[1]
         self.shape = (S, N)
 
     def __getitem__(self, item):
-        return self.tivlist[item]
+        """
+        Get lazily built TIV views of the collection
+        :param item: Sequence index (returns a list of TIVs), or (sequence, position) tuple (returns a TIV)
+        :return: TIV object or list of TIV objects
+        """
+        if isinstance(item, tuple):
+            s, n = item
+            return TIV(self.energies[s, n], self.vectors[s, n])
+        if isinstance(item, slice):
+            return [self[s] for s in range(*item.indices(self.shape[0]))]
+        return [TIV(energy, vector) for energy, vector in zip(self.energies[item], self.vectors[item])]
+
+    def __len__(self):
+        return self.shape[0]
 
     def __repr__(self):
-        return f"TIVCollection ({S} sequences of {N} TIVs)"
+        return f"TIVCollection ({self.shape[0]} sequences of {self.shape[1]} TIVs)"
+
+    @property
+    def dtype(self):
+        """
+        Complex dtype of the vectors
+        """
+        return self.vectors.dtype
+
+    @property
+    def tivlist(self):
+        """
+        Nested list of TIV sequences, built on demand
+        :return: List of S lists containing N TIV objects
+        """
+        return self[:]
+
+    @classmethod
+    def from_tivlist(cls, tivlist):
+        """
+        Build a collection from a list of TIV objects
+        :param tivlist: A list (or a list of lists) containing all the tivs of an audio
+        :return: TIVCollection object
+        """
+        if not all([isinstance(element, list) for element in tivlist]):
+            tivlist = [tivlist]
+
+        if not all([isinstance(tivi, TIV) for innertivlist in tivlist for tivi in innertivlist]):
+            raise TypeError("Some element in the list is not a TIV object")
+
+        energies = np.array([[i.energy for i in innertivlist] for innertivlist in tivlist])
+        vectors = np.array([[i.vector for i in innertivlist] for innertivlist in tivlist])
+        return cls(energies, vectors)
 
     @classmethod
-    def from_pcp(cls, pcp):
+    def from_pcp(cls, pcp, dtype=None):
         """
         Get TIVs from pcp, as the original method
         :param pcp: 12xN or Sx12xN vector, containing S sequences of N pcps
+        :param dtype: Complex dtype of the collection, TIV.default_dtype by default. With np.complex64 the pcps are
+            transformed and stored in single precision
         :return: TIVCollection object
         """
+        constants = cls.constants(dtype)
+        pcp = np.asarray(pcp, dtype=constants['real'])
         if pcp.ndim == 2:       # One PCPs series        (12xN)
             pcp = np.expand_dims(pcp, 0)
-        if pcp.ndim == 3:     # Multiple PCPs series   (Sx12xN)
-            if pcp.shape[1] != 12:
-                raise TypeError("Vector is not compatible with PCP")
-            fft = np.fft.rfft(pcp, n=12, axis=1)
-        else:
+        if pcp.ndim != 3 or pcp.shape[1] != 12:     # Multiple PCPs series   (Sx12xN)
             raise TypeError("Vector is not compatible with PCP")
 
-        S, _, N = pcp.shape
+        # FFT along the pitch axis moved last, so the result is already laid out as SxNx7
+        fft = np.fft.rfft(np.swapaxes(pcp, 1, 2), n=12, axis=2)
+        energy = fft[:, :, 0] + constants['epsilon']
+        vector = np.divide(fft[:, :, 1:7], energy[:, :, np.newaxis])
+        vector *= constants['weights']
+        return cls(energy, vector)
+
+    def transpose(self, n_semitones, inplace=False):
+        """
+        Transpose all the TIVs of the collection by n semitones
+        :param n_semitones: number of semitones to transpose (negative or positive)
+        :param inplace: True to shift the actual TIVCollection object. False to return a shifted copy
+        :return: Shifted TIVCollection version, or None
+        """
+        if n_semitones == 0:
+            return self
+        rotations = self.constants(_complex_dtype(self.vectors))['rotations']
+        transposed_vectors = self.vectors * rotations[n_semitones % 12]
+        if inplace:
+            self.vectors = transposed_vectors
+        else:
+            return TIVCollection(self.energies, transposed_vectors)
 
-        if fft.ndim == 1:
-            fft = fft[:, np.newaxis]
-        energy = fft[:, 0, :] + epsilon
-        vector = fft[:, 1:7, :]
-        vector = ((vector / energy[:, np.newaxis]) * np.array(cls.weights)[:, np.newaxis])
-        return cls( [[TIV(energy[s, n], vector[s, :, n]) for n in range(N) ] for s in range(S)] )
+    def get_12_transposed_vectors(self):
+        """
+        Get the vectors of all 12 possible transpositions for a TIVCollection
+        :return: 12xSx6xN complex array, the first axis being the number of semitones transposed
+        """
+        rotations = self.constants(_complex_dtype(self.vectors))['rotations']
+        return rotations[:, np.newaxis, :, np.newaxis] * np.swapaxes(self.vectors, 1, 2)
 
     def get_12_transposes(self):
         """
         Get all 12 possible transpositions for a TIVCollection
         :return:List with all 12 possible transpositions [0-11]
         """
-        n = 12
-        mod = np.abs(self.vectors)
-        phase = 1j * np.angle(self.vectors)
-        matmul = -2j * np.pi * (np.arange(12)[:, np.newaxis] * np.ones((6, 12, len(self.tivlist)), dtype=np.float64))
-        matmul = np.transpose(matmul, axes=(2, 0, 1))
-        semitones = np.arange(1, 7, dtype=np.float64)
-        semitones = semitones[:, np.newaxis]
-        phase_transposition = semitones * matmul / n
-        new_phase = phase[:, :, np.newaxis] + phase_transposition
-        new_vectors = mod[:, :, np.newaxis] * np.exp(new_phase)
-        tivlists = []  # Will be length 12 containing all the 12 pitch shifts.
-        for shift in range(n):
-            set_tivs = []  # Aux variable to hold the set of tivs for this shift
-            for tiv in range(len(self.energies)):
-                set_tivs.append(TIV(self.energies[tiv], new_vectors[tiv, :, shift]))
-            tivlists.append(TIVCollection(set_tivs))
-        return tivlists
+        transposed_vectors = self.get_12_transposed_vectors()
+        return [TIVCollection(self.energies, np.swapaxes(vectors, 1, 2)) for vectors in transposed_vectors]
+
+    def keys(self, mode='temperley', reference=0):
+        """
+        Estimate the key of every TIV of the collection in a single distance computation.
+        For the keys of a whole HPCP corpus: TIVCollection.from_pcp(hpcps.T).keys(reference=9), spoty_hpcps.npy
+        profiles starting at A
+        :param mode: 'temperley' or 'shaath' key profiles
+        :param reference: Pitch class (0 is C) of the first bin of the pcps, e.g. 9 for pcps that start at A. The keys
+            are always given from C
+        :return: SxN integer key codes (0-11 major, 12-23 minor) and SxN array with the matching key_labels
+        """
+        profiles, alpha = self.get_key_profiles(mode, _complex_dtype(self.vectors))
+        if reference % 12:
+            # Same as transposing the vectors by reference semitones, on the 24 profiles instead
+            profiles = profiles * self.constants(_complex_dtype(self.vectors))['rotations'][reference % 12].conj()
+        # |alpha*v - p|^2 = alpha^2 |v|^2 - 2 alpha Re<v, p> + |p|^2, the first term is the same for all profiles
+        distances = np.sum(np.abs(profiles) ** 2, axis=1) - 2 * alpha * np.real(self.vectors @ profiles.conj().T)
+        codes = np.argmin(distances, axis=2)
+        return codes, np.array(self.key_labels)[codes]
 
     def small_scale_compatibility(self, tivcol2):
         """
@@ -389,9 +514,10 @@ class TIVCollection(TIV):
         vectorq = self.vectors
         vectorc = tivcol2.vectors
 
+        norm_weights = self.constants()['norm_weights']
         prelatedntess = np.linalg.norm(vectorq-vectorc, axis=2)
-        n_prelatedness = prelatedntess/(np.linalg.norm(self.weights)*2)
-        n_dissonance = 1 - ( np.linalg.norm(((vectorq + vectorc)), axis=2) / np.linalg.norm(self.weights) )
+        n_prelatedness = prelatedntess/(norm_weights*2)
+        n_dissonance = 1 - ( np.linalg.norm(((vectorq + vectorc)), axis=2) / norm_weights )
 
         h_comps = n_prelatedness * n_dissonance
 
@@ -403,12 +529,21 @@ class TIVCollection(TIV):
         :param tivcol2: TIVCollection object to compare against
         :return: A tuple containing pitch shift and small scale compatibility
         """
-        tiv2transposes = tivcol2.get_12_transposes()
-        compatibilities = np.zeros(12)
-        for idx, transpose in enumerate(tiv2transposes):
-            compatibilities[idx] = self.small_scale_compatibility(transpose)
-
-        pitch_shift = np.argmin(compatibilities)
-        if pitch_shift > 5:
-            pitch_shift = pitch_shift - 12
-        return pitch_shift, np.min(compatibilities)
+        if tivcol2.shape[1] != self.shape[1]:
+            raise ValueError("Compatibility between different TIVCollections sizes are not supported yet")
+        if self.shape[0] != 1:
+            raise ValueError("Query TIV can only have 1 sequence")
+        tiv2transposes = tivcol2.get_12_transposed_vectors()        # 12xSx6xN
+        vectorq = np.swapaxes(self.vectors, 1, 2)                   # 1x6xN
+        norm_weights = self.constants()['norm_weights']
+
+        n_prelatedness = np.linalg.norm(vectorq - tiv2transposes, axis=2) / (norm_weights * 2)
+        n_dissonance = 1 - (np.linalg.norm(vectorq + tiv2transposes, axis=2) / norm_weights)
+        compatibilities = np.sum(n_prelatedness * n_dissonance, axis=2)     # 12xS
+
+        pitch_shift = np.argmin(compatibilities, axis=0)
+        pitch_shift = np.where(pitch_shift > 5, pitch_shift - 12, pitch_shift)
+        compatibility = np.min(compatibilities, axis=0)
+        if tivcol2.shape[0] == 1:
+            return pitch_shift[0], compatibility[0]
+        return pitch_shift, compatibility
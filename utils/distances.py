@@ -0,0 +1,249 @@
+from collections import namedtuple
+
+import numpy as np
+
+from tivlib import compatibility_matrix
+from utils.ph_harm import ph_harmon_masks
+
+# Valid transitions in the circle of fifths (plus the enharmonics):
+CIRCLE_TRANSITIONS = {'Cmajor': ['Cmajor', 'Aminor', 'Fmajor', 'Gmajor'],
+                      'Gmajor': ['Gmajor', 'Dmajor', 'Cmajor', 'Eminor'],
+                      'Dmajor': ['Dmajor', 'Amajor', 'Gmajor', 'Bminor'],
+                      'Amajor': ['Amajor', 'Dmajor', 'Emajor', 'F#minor'],
+                      'Emajor': ['Emajor', 'Amajor', 'Bmajor', 'Cbmajor', 'C#minor'],
+                      'Bmajor': ['Bmajor', 'Cbmajor', 'Emajor', 'F#major', 'Gbmajor', 'G#minor', 'Abminor'],
+                      'Cbmajor': ['Bmajor', 'Cbmajor', 'Emajor', 'F#major', 'Gbmajor', 'G#minor', 'Abminor'],
+                      'F#major': ['F#major', 'Gbmajor', 'Bmajor', 'Cbmajor', 'Dbmajor', 'C#major', 'D#minor',
+                                  'Ebminor'],
+                      'Gbmajor': ['Gbmajor', 'F#major', 'Bmajor', 'Cbmajor', 'Dbmajor', 'C#major', 'D#minor',
+                                  'Ebminor'],
+                      'C#major': ['C#major', 'Dbmajor', 'F#major', 'Gbmajor', 'Abmajor', 'Bbminor', 'A#minor'],
+                      'Dbmajor': ['Dbmajor', 'C#major', 'F#major', 'Gbmajor', 'Abmajor', 'Bbminor', 'A#minor'],
+                      'Abmajor': ['Abmajor', 'Dbmajor', 'C#major', 'Ebmajor', 'Fminor'],
+                      'Ebmajor': ['Ebmajor', 'Abmajor', 'Bbmajor', 'Cminor'],
+                      'Bbmajor': ['Bbmajor', 'Ebmajor', 'Fmajor', 'Gminor'],
+                      'Fmajor': ['Fmajor', 'Bbmajor', 'Cmajor', 'Dminor'],
+                      'Aminor': ['Aminor', 'Eminor', 'Dminor', 'Cmajor'],
+                      'Eminor': ['Eminor', 'Bminor', 'Aminor', 'Gmajor'],
+                      'Bminor': ['Bminor', 'F#minor', 'Eminor', 'Dmajor'],
+                      'F#minor': ['F#minor', 'C#minor', 'Bminor', 'Amajor'],
+                      'C#minor': ['C#minor', 'F#minor', 'Abminor', 'G#minor', 'Emajor'],
+                      'G#minor': ['G#minor', 'Abminor', 'C#minor', 'Ebminor', 'D#minor', 'Bmajor', 'Cbmajor'],
+                      'Abminor': ['Abminor', 'G#minor', 'C#minor', 'Ebminor', 'D#minor', 'Bmajor', 'Cbmajor'],
+                      'D#minor': ['D#minor', 'Ebminor', 'Abminor', 'G#minor', 'Bbminor', 'A#minor', 'F#major',
+                                  'Gbmajor'],
+                      'Ebminor': ['Ebminor', 'D#minor', 'Abminor', 'G#minor', 'Bbminor', 'A#minor', 'F#major',
+                                  'Gbmajor'],
+                      'A#minor': ['A#minor', 'Bbminor', 'Ebminor', 'D#minor', 'Fminor', 'Dbmajor', 'C#major'],
+                      'Bbminor': ['Bbminor', 'A#minor', 'Ebminor', 'D#minor', 'Fminor', 'Dbmajor', 'C#major'],
+                      'Dminor': ['Dminor', 'Aminor', 'Gminor', 'Fmajor'],
+                      'Gminor': ['Gminor', 'Dminor', 'Cminor', 'Bbmajor'],
+                      'Cminor': ['Cminor', 'Gminor', 'Fminor', 'Ebmajor'],
+                      'Fminor': ['Fminor', 'Bbminor', 'A#minor', 'Cminor', 'Abmajor']}
+
+
+def _circle_coordinates():
+    # coordinates on the circle of fifths:
+    maj_keys = ['Cmajor', 'Gmajor', 'Dmajor', 'Amajor', 'Emajor', 'Bmajor', 'F#major', 'C#major', 'Abmajor',
+                'Ebmajor', 'Bbmajor', 'Fmajor']
+    min_keys = ['Aminor', 'Eminor', 'Bminor', 'F#minor', 'C#minor', 'G#minor', 'D#minor', 'A#minor', 'Fminor',
+                'Cminor', 'Gminor', 'Dminor']
+
+    radius = 3.863708  # radius of the circle. this value makes vertical and horizontal translation the same
+    radius = radius * 2
+    h = 2.  # distance between adjacent keys
+    h = h * 2
+    coordinates = {}
+    for i, key in enumerate(maj_keys):
+        coordinates[key] = np.array([radius * np.cos((np.pi * i) / 6), radius * np.sin((np.pi * i) / 6), 0.])
+    for i, key in enumerate(min_keys):
+        coordinates[key] = np.array([radius * np.cos((np.pi * i) / 6), radius * np.sin((np.pi * i) / 6), h])
+    # and we add the enharmonic equivalents
+    coordinates['Cbmajor'] = coordinates['Bmajor']
+    coordinates['Gbmajor'] = coordinates['F#major']
+    coordinates['Dbmajor'] = coordinates['C#major']
+    coordinates['Abminor'] = coordinates['G#minor']
+    coordinates['Ebminor'] = coordinates['D#minor']
+    coordinates['Bbminor'] = coordinates['A#minor']
+    return coordinates
+
+
+CIRCLE_COORDINATE = _circle_coordinates()
+
+# Pitch class (0 is C) of the first bin of the corpus hpcps (spoty_hpcps.npy), which start at A
+HPCP_REFERENCE = 9
+
+# Integer code of every key name, used to index the lookup tables below
+KEY_NAMES = list(CIRCLE_TRANSITIONS)
+KEY_CODES = {key: code for code, key in enumerate(KEY_NAMES)}
+
+# Code of the tracks whose key is missing or unknown
+UNKNOWN_KEY = -1
+
+# 31x31 lookup tables of the key-based methods, indexed by key code. The last row and column are the unknown key,
+# at the largest distance from every key (itself included)
+BINARY_TABLE = np.ones((len(KEY_NAMES) + 1, len(KEY_NAMES) + 1), dtype=np.float32)
+BINARY_TABLE[:-1, :-1] = [[0 if next_key in CIRCLE_TRANSITIONS[current_key] else 1 for next_key in KEY_NAMES]
+                          for current_key in KEY_NAMES]
+_coordinates = np.array([CIRCLE_COORDINATE[key] for key in KEY_NAMES])
+CIRCLE_TABLE = np.empty((len(KEY_NAMES) + 1, len(KEY_NAMES) + 1), dtype=np.float32)
+CIRCLE_TABLE[:-1, :-1] = np.linalg.norm(_coordinates[:, np.newaxis] - _coordinates, axis=2)
+CIRCLE_TABLE[-1, :] = CIRCLE_TABLE[:, -1] = CIRCLE_TABLE[:-1, :-1].max()
+
+# Features of the tracks of a playlist: N uris, N key codes and Nx12 hpcps
+TrackFeatures = namedtuple('TrackFeatures', ['uris', 'keys', 'hpcps'])
+
+
+def key_codes(keys):
+    """
+    Converts key names ('C#major', 'Abminor', ...) to integer key codes
+    :param keys: Iterable of key names
+    :return: int8 array with the key codes
+    """
+    return np.array([KEY_CODES[key] for key in keys], dtype=np.int8)
+
+
+def _table_codes(keys):
+    # Row of the lookup tables of every key code, the unknown keys (negative codes) on the last one
+    keys = np.asarray(keys)
+    return np.where(keys < 0, len(KEY_NAMES), keys)
+
+
+def playlist_features(playlist, hfeats):
+    """
+    Gathers the features of the tracks of a playlist
+    :param playlist: Playlist dict, as in top1000_playlists.json
+    :param hfeats: FeatureStore, or dict of track features by uri with 'key' and 'hpcp' entries
+    :return: TrackFeatures of the playlist tracks, in playlist order
+    """
+    uris = [track['track_uri'] for track in playlist['tracks']]
+    if hasattr(hfeats, 'gather'):
+        return hfeats.gather(uris)
+    keys = key_codes([hfeats[uri]['key'] for uri in uris])
+    hpcps = np.array([hfeats[uri]['hpcp'] for uri in uris], dtype=np.float32).reshape(len(uris), 12)
+    return TrackFeatures(uris, keys, hpcps)
+
+
+def top_pitch_classes(hpcps, n=3):
+    """
+    Bitmask of the top-n pitch classes of each hpcp, rotated to match the ph algorithm (pitch class 0 is C)
+    :param hpcps: Nx12 array of hpcps starting at HPCP_REFERENCE
+    :param n: Number of pitch classes taken from each hpcp
+    :return: Integer array with a bitmask per hpcp
+    """
+    chords = (np.argsort(hpcps, axis=1)[:, ::-1][:, :n] + HPCP_REFERENCE) % 12
+    return np.bitwise_or.reduce(1 << chords, axis=1)
+
+
+# Diversity metrics (not used in the evaluation)
+# Every builder compares the tracks of features (rows) with the tracks of other (columns), by default features itself
+
+def diver_binary(features, other=None):
+    # 1 when both tracks have the same known key, 0 otherwise
+    other = features if other is None else other
+    return ((features.keys[:, np.newaxis] == other.keys) & (other.keys >= 0)).astype(np.float32)
+
+
+def diver_hpcp(features, other=None):
+    # Cosine similarity between hpcps
+    other = features if other is None else other
+    hpcps = np.asarray(features.hpcps, dtype=np.float64)
+    other_hpcps = np.asarray(other.hpcps, dtype=np.float64)
+    norms = np.linalg.norm(hpcps, axis=1)
+    other_norms = np.linalg.norm(other_hpcps, axis=1)
+    return ((hpcps @ other_hpcps.T) / np.outer(norms, other_norms)).astype(np.float32)
+
+
+# Compatibility distances
+
+def comp_binary(features, other=None):
+    # Binary method.
+    # Adjacent boxes in the circle of fiths transitions have 0 cost, 1 otherwise
+    other = features if other is None else other
+    return BINARY_TABLE[_table_codes(features.keys)[:, np.newaxis], _table_codes(other.keys)]
+
+
+def comp_circle(features, other=None):
+    # Circle method
+    # Euclidean distance on the coordinates of the circle of fifths in R3
+    other = features if other is None else other
+    return CIRCLE_TABLE[_table_codes(features.keys)[:, np.newaxis], _table_codes(other.keys)]
+
+
+def comp_TIV(features, other=None):
+    # TIV method
+    # use TIVlib small_scale_compatibility
+    return compatibility_matrix(features.hpcps, None if other is None else other.hpcps)
+
+
+def comp_ph(features, other=None):
+    # Harrison & Pearce consonance
+    # We take the top-3 pitch classes from each track, merge them in a single chord and compute its harmonicity
+    chords = top_pitch_classes(features.hpcps)
+    other_chords = chords if other is None else top_pitch_classes(other.hpcps)
+    return ph_harmon_masks(chords[:, np.newaxis] | other_chords).astype(np.float32)
+
+
+METHODS = {'diver_binary': diver_binary,
+           'diver_hpcp': diver_hpcp,
+           'binary': comp_binary,
+           'circle': comp_circle,
+           'tiv': comp_TIV,
+           'ph': comp_ph}
+
+
+def distance_matrix(method, features, fixed_start=True):
+    """
+    Fills the distance matrix of a playlist as required by the TSP solvers
+    :param method: One of METHODS
+    :param features: TrackFeatures of the playlist tracks
+    :param fixed_start: If True, the first column is zeroed so the path is open and starts at the first track
+    :return: NxN float32 distance matrix
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method '{method}', expected one of {list(METHODS)}")
+    matrix = METHODS[method](features)
+    if fixed_start:
+        matrix[:, 0] = 0
+    return matrix
+
+
+def _subset(features, positions):
+    return TrackFeatures([features.uris[i] for i in positions], features.keys[positions], features.hpcps[positions])
+
+
+def update_distance_matrix(method, matrix, previous_uris, features, fixed_start=True):
+    """
+    Distance matrix of a playlist after some tracks were added, removed or moved, computing only the rows and
+    columns of the added tracks. The distances between the tracks that were already there are reused
+    :param method: One of METHODS, the one used for matrix
+    :param matrix: Distance matrix of the previous version of the playlist, as returned by distance_matrix
+    :param previous_uris: Track uris of the previous version of the playlist, in the order of matrix
+    :param features: TrackFeatures of the new version of the playlist
+    :param fixed_start: If True, the first column is zeroed so the path is open and starts at the first track
+    :return: A tuple with the NxN float32 distance matrix and, for each track, its index in the previous playlist
+        (-1 for the added tracks)
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method '{method}', expected one of {list(METHODS)}")
+    previous_rows = {}
+    for row, uri in enumerate(previous_uris):
+        previous_rows.setdefault(uri, row)
+    previous = np.array([previous_rows.pop(uri, -1) for uri in features.uris], dtype=np.int64)
+    kept = np.flatnonzero(previous >= 0)
+    added = np.flatnonzero(previous < 0)
+    # With fixed_start the column of the previous first track was zeroed, it has to be computed again
+    if fixed_start and len(previous_uris) and 0 in previous[kept]:
+        added = np.union1d(added, np.flatnonzero(previous == 0))
+        kept = np.setdiff1d(kept, added)
+
+    n = len(features.uris)
+    updated = np.empty((n, n), dtype=np.float32)
+    updated[np.ix_(kept, kept)] = np.asarray(matrix)[np.ix_(previous[kept], previous[kept])]
+    if len(added):
+        builder = METHODS[method]
+        updated[added] = builder(_subset(features, added), features)
+        updated[:, added] = builder(features, _subset(features, added))
+    if fixed_start:
+        updated[:, 0] = 0
+    return updated, previous
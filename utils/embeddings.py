@@ -0,0 +1,374 @@
+"""
+Learned embeddings of the audio previews, computed with the AudioEncoder of utils/utils.py.
+
+Worker processes decode the previews (with ffmpeg) and cut their log-mel spectrograms into 48x256 patches, while the
+main process runs the encoder on large batches of patches. The embedding of a track is the mean of the embeddings
+of its patches, and is written as soon as it is computed to a memory-mapped (N, 128) float32 array, so an
+interrupted run resumes where it stopped:
+
+    python -m utils.embeddings --previews spotify_data/previews --weights audio_encoder.pt --out spoty_embeddings
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from os.path import join as pjoin
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Spectrogram parameters: 16 ms hops, so a 48x256 patch covers ~4.1 s and a 30 s preview gives 7 patches
+SAMPLE_RATE = 16000
+N_FFT = 512
+HOP_LENGTH = 256
+N_MELS = 48
+PATCH_FRAMES = 256
+# Added to the mel energies before the log
+LOG_OFFSET = 1e-6
+# Size of the embeddings of AudioEncoder
+EMBEDDING_SIZE = 128
+# Patches per forward pass of the encoder
+BATCH_SIZE = 256
+
+
+def preview_files(previews_dir):
+    """
+    Previews of a directory of '<uri>.mp3' files, as downloaded by spotify_data_preparation.ipynb
+    :return: Dict of file paths by uri, sorted by uri
+    """
+    files = sorted(file for file in os.listdir(previews_dir) if file.endswith('.mp3'))
+    return {os.path.splitext(file)[0]: pjoin(previews_dir, file) for file in files}
+
+
+def decode_audio(path, sample_rate=SAMPLE_RATE):
+    """
+    Mono signal of an audio file, decoded and resampled by ffmpeg
+    :return: float32 array
+    """
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', path, '-f', 'f32le', '-ac', '1', '-ar', str(sample_rate),
+               '-']
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(output, dtype=np.float32)
+
+
+@lru_cache(maxsize=None)
+def mel_filterbank(sample_rate=SAMPLE_RATE, n_fft=N_FFT, n_mels=N_MELS):
+    """
+    Triangular filters on the HTK mel scale, from 0 Hz to the Nyquist frequency
+    :return: n_mels x (n_fft // 2 + 1) float32 array
+    """
+    def hz_to_mel(f):
+        return 2595. * np.log10(1. + f / 700.)
+
+    def mel_to_hz(m):
+        return 700. * (10. ** (m / 2595.) - 1.)
+
+    frequencies = np.linspace(0, sample_rate / 2, n_fft // 2 + 1)
+    edges = mel_to_hz(np.linspace(0, hz_to_mel(sample_rate / 2), n_mels + 2))
+    lower, center, upper = edges[:-2, np.newaxis], edges[1:-1, np.newaxis], edges[2:, np.newaxis]
+    rising = (frequencies - lower) / (center - lower)
+    falling = (upper - frequencies) / (upper - center)
+    return np.maximum(0, np.minimum(rising, falling)).astype(np.float32)
+
+
+def log_mel_patches(signal, sample_rate=SAMPLE_RATE):
+    """
+    Log-mel spectrogram of a signal, cut into non overlapping patches. A signal shorter than a patch is padded with
+    silence
+    :param signal: Mono signal
+    :param sample_rate: Sample rate of the signal
+    :return: P x N_MELS x PATCH_FRAMES float32 array
+    """
+    min_length = N_FFT + (PATCH_FRAMES - 1) * HOP_LENGTH
+    if len(signal) < min_length:
+        signal = np.pad(signal, (0, min_length - len(signal)))
+    frames = np.lib.stride_tricks.sliding_window_view(signal, N_FFT)[::HOP_LENGTH]
+    power = np.abs(np.fft.rfft(frames * np.hanning(N_FFT).astype(np.float32), axis=1)) ** 2     # T x F
+    mel = np.log(power.astype(np.float32) @ mel_filterbank(sample_rate).T + LOG_OFFSET)        # T x N_MELS
+    n_patches = len(mel) // PATCH_FRAMES
+    patches = mel[:n_patches * PATCH_FRAMES].reshape(n_patches, PATCH_FRAMES, N_MELS)
+    return np.ascontiguousarray(patches.transpose(0, 2, 1))
+
+
+def track_patches(path):
+    """
+    Spectrogram patches of a preview, in a worker process
+    :return: P x N_MELS x PATCH_FRAMES array, or None if the file cannot be decoded
+    """
+    try:
+        signal = decode_audio(path)
+    except subprocess.CalledProcessError:
+        return None
+    if len(signal) == 0:
+        return None
+    return log_mel_patches(signal)
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped (N, EMBEDDING_SIZE) float32 embeddings indexed by track uri. The rows of the tracks that are not
+    computed yet are NaN, and done marks the computed ones
+    """
+    def __init__(self, path, mode='r'):
+        """
+        Opens an existing store
+        :param path: Directory of the store, as written by EmbeddingStore.create
+        :param mode: 'r' to read, 'r+' to write embeddings
+        """
+        self.path = path
+        self.mode = mode
+        self._load()
+
+    def _load(self):
+        with open(pjoin(self.path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.uris = np.load(pjoin(self.path, 'uris.npy'))
+        # The arrays can be longer than uris after an interrupted append, their extra rows are not used
+        self.embeddings = np.load(pjoin(self.path, 'embeddings.npy'), mmap_mode=self.mode)
+        self.done = np.load(pjoin(self.path, 'done.npy'), mmap_mode=self.mode)
+        self._rows = {uri: row for row, uri in enumerate(self.uris)}
+
+    def __len__(self):
+        return len(self.uris)
+
+    def __contains__(self, uri):
+        return uri in self._rows
+
+    def __getitem__(self, uri):
+        return self.embeddings[self._rows[uri]]
+
+    def __repr__(self):
+        return f"EmbeddingStore ({int(np.sum(self.done))}/{len(self)} tracks at {self.path})"
+
+    def row(self, uri):
+        """
+        Row of a track in the store
+        """
+        return self._rows[uri]
+
+    def rows(self, uris):
+        """
+        Rows of many tracks in the store
+        :param uris: Iterable of track uris
+        :return: Integer array with the row index of each uri
+        """
+        return np.array([self._rows[uri] for uri in uris], dtype=np.int64)
+
+    def gather(self, uris):
+        """
+        Embeddings of a list of tracks
+        :return: len(uris) x EMBEDDING_SIZE float32 array
+        """
+        return self.embeddings[self.rows(uris)]
+
+    def flush(self):
+        self.embeddings.flush()
+        self.done.flush()
+
+    def append(self, uris):
+        """
+        Adds empty rows for new tracks. The arrays are rewritten with the new rows and replace the old ones, the uris
+        last, so an interrupted append leaves the store with its previous tracks
+        :param uris: Track uris, the ones already in the store are skipped
+        """
+        uris = [uri for uri in dict.fromkeys(uris) if uri not in self._rows]
+        if not uris:
+            return
+        n, size = len(self.uris), self.embeddings.shape[1]
+        embeddings = np.lib.format.open_memmap(pjoin(self.path, 'embeddings.tmp.npy'), mode='w+', dtype=np.float32,
+                                               shape=(n + len(uris), size))
+        embeddings[:n] = self.embeddings[:n]
+        embeddings[n:] = np.nan
+        embeddings.flush()
+        del embeddings
+        np.save(pjoin(self.path, 'done.tmp.npy'), np.concatenate([self.done[:n], np.zeros(len(uris), dtype=bool)]))
+        np.save(pjoin(self.path, 'uris.tmp.npy'), np.concatenate([self.uris, np.array(uris, dtype=str)]))
+        # The memory maps of the old arrays are closed before they are replaced
+        self.flush()
+        self.embeddings = self.done = None
+        for name in ('embeddings', 'done', 'uris'):
+            os.replace(pjoin(self.path, name + '.tmp.npy'), pjoin(self.path, name + '.npy'))
+        with open(pjoin(self.path, 'meta.json.tmp'), 'w') as f:
+            json.dump(dict(self.meta, n_tracks=n + len(uris)), f)
+        os.replace(pjoin(self.path, 'meta.json.tmp'), pjoin(self.path, 'meta.json'))
+        self._load()
+
+    @classmethod
+    def create(cls, path, uris, size=EMBEDDING_SIZE):
+        """
+        Creates an empty store
+        :param path: Directory of the store, created if needed
+        :param uris: N track uris
+        :param size: Size of the embeddings
+        :return: The store, opened for writing
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(pjoin(path, 'uris.npy'), np.array(list(uris), dtype=str))
+        embeddings = np.lib.format.open_memmap(pjoin(path, 'embeddings.npy'), mode='w+', dtype=np.float32,
+                                               shape=(len(uris), size))
+        embeddings[:] = np.nan
+        embeddings.flush()
+        np.save(pjoin(path, 'done.npy'), np.zeros(len(uris), dtype=bool))
+        # The metadata is written last, a store without it is incomplete
+        with open(pjoin(path, 'meta.json'), 'w') as f:
+            json.dump({'n_tracks': len(uris), 'size': size, 'sample_rate': SAMPLE_RATE, 'n_fft': N_FFT,
+                       'hop_length': HOP_LENGTH, 'n_mels': N_MELS, 'patch_frames': PATCH_FRAMES}, f)
+        return cls(path, mode='r+')
+
+
+def _fuse(model):
+    # Folds every BatchNorm2d into the preceding convolution and merges the ReLU, the model must be in eval mode
+    from utils.utils import Conv_2d, Conv_emb
+    quantization = getattr(torch, 'ao', torch).quantization
+    for module in model.modules():
+        if isinstance(module, (Conv_2d, Conv_emb)):
+            quantization.fuse_modules(module, [['conv', 'bn', 'relu']], inplace=True)
+    return model
+
+
+def load_encoder(weights=None, quantize=False):
+    """
+    AudioEncoder ready for CPU inference: in eval mode, with the batch norms of the convolutions folded into them and
+    optionally with its linear layers dynamically quantized to int8
+    :param weights: Path of a state_dict saved with torch.save, or None for the random initialization
+    :param quantize: Whether to quantize the linear layers (the convolutions, most of the cost, stay float32)
+    :return: The model
+    """
+    if torch is None:
+        raise ImportError("Computing the embeddings needs torch")
+    from utils.utils import AudioEncoder
+    model = AudioEncoder()
+    if weights is not None:
+        model.load_state_dict(torch.load(weights, map_location='cpu'))
+    model = _fuse(model.eval())
+    if quantize:
+        quantization = getattr(torch, 'ao', torch).quantization
+        model = quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def encode(model, patches):
+    """
+    Embeddings of a batch of spectrogram patches
+    :param model: Model returned by load_encoder
+    :param patches: B x N_MELS x PATCH_FRAMES array
+    :return: B x EMBEDDING_SIZE float32 array
+    """
+    x = torch.from_numpy(patches).unsqueeze(1)
+    with torch.inference_mode():
+        _, embeddings = model(x)
+    return embeddings.numpy()
+
+
+def set_threads(threads):
+    """
+    Number of threads of the torch operators. The inter-op pool is not used by a sequential model
+    """
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # it can only be set before the first parallel operation
+
+
+def embed_previews(previews, out_path, weights=None, batch_size=BATCH_SIZE, workers=None, threads=None,
+                   quantize=False, progress=None):
+    """
+    Computes the embeddings of the previews that are not in the store yet
+    :param previews: Dict of mp3 paths by uri, e.g. from preview_files
+    :param out_path: Directory of the EmbeddingStore, created if it does not exist and grown with the new previews
+        if it does
+    :param weights: Path of the AudioEncoder state_dict
+    :param batch_size: Patches per forward pass
+    :param workers: Decoding processes, half of the CPUs by default
+    :param threads: Torch threads, the rest of the CPUs by default
+    :param quantize: Whether to quantize the linear layers of the encoder
+    :param progress: Optional wrapper of the iterable of tracks, e.g. tqdm
+    :return: A tuple with the store and the list of uris that could not be decoded
+    """
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError("Decoding the previews needs ffmpeg")
+    if os.path.exists(pjoin(out_path, 'meta.json')):
+        store = EmbeddingStore(out_path, mode='r+')
+        store.append(previews)
+    else:
+        store = EmbeddingStore.create(out_path, list(previews))
+    uris = [uri for uri, done in zip(previews, store.done[store.rows(previews)]) if not done]
+
+    n_cpus = os.cpu_count() or 1
+    workers = workers or max(1, n_cpus // 2)
+    set_threads(threads or max(1, n_cpus - workers))
+    model = load_encoder(weights, quantize)
+
+    failed = []
+    pending_rows, pending_patches = [], []
+
+    def write_batch():
+        patches = np.concatenate(pending_patches)
+        embeddings = encode(model, patches)
+        counts = [len(p) for p in pending_patches]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        store.embeddings[pending_rows] = np.add.reduceat(embeddings, starts, axis=0) / np.array(counts)[:, None]
+        store.done[pending_rows] = True
+        pending_rows.clear()
+        pending_patches.clear()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # At most a few tracks per worker in flight, so the decoded spectrograms do not pile up in memory
+        queue, tracks = deque(), iter(uris)
+        for uri in tracks:
+            queue.append((uri, executor.submit(track_patches, previews[uri])))
+            if len(queue) >= 4 * workers:
+                break
+        bar = progress(total=len(uris)) if progress is not None else None
+        while queue:
+            uri, future = queue.popleft()
+            next_uri = next(tracks, None)
+            if next_uri is not None:
+                queue.append((next_uri, executor.submit(track_patches, previews[next_uri])))
+            patches = future.result()
+            if patches is None:
+                failed.append(uri)
+            else:
+                pending_rows.append(store.row(uri))
+                pending_patches.append(patches)
+                if sum(len(p) for p in pending_patches) >= batch_size:
+                    write_batch()
+            if bar is not None:
+                bar.update()
+        if pending_rows:
+            write_batch()
+        if bar is not None:
+            bar.close()
+    store.flush()
+    return store, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--previews', required=True, help='Directory with the <uri>.mp3 previews')
+    parser.add_argument('--weights', required=True, help='AudioEncoder state_dict')
+    parser.add_argument('--out', required=True, help='Directory of the embedding store')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Patches per forward pass')
+    parser.add_argument('--workers', type=int, default=None, help='Decoding processes, half of the CPUs by default')
+    parser.add_argument('--threads', type=int, default=None, help='Torch threads, the rest of the CPUs by default')
+    parser.add_argument('--quantize', action='store_true', help='Quantize the linear layers to int8')
+    args = parser.parse_args(argv)
+    store, failed = embed_previews(preview_files(args.previews), args.out, args.weights, args.batch_size,
+                                   args.workers, args.threads, args.quantize, progress=tqdm)
+    print(store)
+    if failed:
+        print(f"{len(failed)} previews could not be decoded, e.g. {failed[0]}")
+
+
+if __name__ == '__main__':
+    main()
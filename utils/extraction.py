@@ -0,0 +1,243 @@
+"""
+Harmonic and rhythmic features of the audio previews, extracted with Essentia.
+
+A pool of worker processes analyses the previews in spotify_data/previews: frame-level HPCPs, and the track HPCP
+(their mean), key, tempo and danceability. The HPCPs start at A, as the ones of spoty_hpcps.npy (see
+utils.distances.HPCP_REFERENCE), so both can be mixed. The results are appended, as soon as each track is done, to an
+ExtractionStore: a flat float32 file with the frames of all the tracks and a jsonl file with one record per track,
+with the position of its frames. The previews that cannot be analysed are listed in its failed.txt. Tracks already in
+the store or failed are skipped, so adding previews and running again only analyses the new files:
+
+    python -m utils.extraction --previews spotify_data/previews --out spoty_extraction --features spoty_features
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import join as pjoin
+
+import numpy as np
+from tqdm import tqdm
+
+from utils.distances import KEY_CODES
+from utils.embeddings import preview_files
+from utils.features import UNKNOWN_KEY, FeatureStore
+from utils.files import terminate_last_line
+
+try:
+    import essentia.standard as es
+except ImportError:
+    es = None
+
+SAMPLE_RATE = 44100
+FRAME_SIZE = 4096
+HOP_SIZE = 2048
+# Essentia HPCPs start at the reference frequency, A as in the corpus HPCPs
+REFERENCE_FREQUENCY = 440.
+# Tracks sent to the workers ahead of the ones being written
+MAX_PENDING = 64
+
+
+def extract_track(path):
+    """
+    Features of a preview, in a worker process
+    :param path: Audio file
+    :return: Dict with the Tx12 frame HPCPs and the track HPCP (starting at A), key, key strength, tempo and
+        danceability, or None if the file cannot be decoded, is shorter than a frame or any step of the analysis fails
+    """
+    try:
+        return _analyse(path)
+    except Exception as e:
+        # Essentia raises RuntimeError for most errors, but any error only fails this preview, not the run
+        print(f"Could not analyse {path}: {e!r}", file=sys.stderr)
+        return None
+
+
+def _analyse(path):
+    audio = es.MonoLoader(filename=path, sampleRate=SAMPLE_RATE)()
+    if len(audio) < FRAME_SIZE:
+        return None
+
+    window = es.Windowing(type='blackmanharris62', size=FRAME_SIZE)
+    spectrum = es.Spectrum(size=FRAME_SIZE)
+    peaks = es.SpectralPeaks(orderBy='magnitude', magnitudeThreshold=1e-5, minFrequency=20, maxFrequency=3500,
+                             maxPeaks=60, sampleRate=SAMPLE_RATE)
+    hpcp = es.HPCP(size=12, referenceFrequency=REFERENCE_FREQUENCY, harmonics=8, bandPreset=True, minFrequency=20,
+                   maxFrequency=3500, weightType='cosine', nonLinear=False, windowSize=1., normalized='unitMax',
+                   sampleRate=SAMPLE_RATE)
+    frames = np.array([hpcp(*peaks(spectrum(window(frame))))
+                       for frame in es.FrameGenerator(audio, frameSize=FRAME_SIZE, hopSize=HOP_SIZE,
+                                                      startFromZero=True)], dtype=np.float32)
+    track_hpcp = frames.mean(axis=0)
+    key, scale, strength = es.Key(profileType='edma')(track_hpcp)
+    tempo = es.RhythmExtractor2013(method='multifeature')(audio)[0]
+    danceability = es.Danceability(sampleRate=SAMPLE_RATE)(audio)[0]
+    return {'frames': frames,
+            'hpcp': track_hpcp,
+            'key': key + scale,
+            'key_strength': float(strength),
+            'tempo': float(tempo),
+            'danceability': float(danceability)}
+
+
+class ExtractionStore:
+    """
+    Append-only store of extracted features: frames.f32 holds the frame HPCPs of all the tracks one after the other,
+    and tracks.jsonl one record per track with its track-level features and the offset and number of its frames.
+    failed.txt lists the uris of the previews that could not be analysed
+    """
+    def __init__(self, path):
+        """
+        Opens a store, created if it does not exist
+        :param path: Directory of the store
+        """
+        self.path = path
+        self.records = {}
+        self.failed = set()
+        os.makedirs(path, exist_ok=True)
+        self._frames_path = pjoin(path, 'frames.f32')
+        self._records_path = pjoin(path, 'tracks.jsonl')
+        self._failed_path = pjoin(path, 'failed.txt')
+        if os.path.exists(self._records_path):
+            with open(self._records_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[record['uri']] = record
+        # Frames written by a crash before their record are dropped
+        self.n_frames = max((record['offset'] + record['n_frames'] for record in self.records.values()), default=0)
+        with open(self._frames_path, 'ab') as f:
+            f.truncate(self.n_frames * 12 * 4)
+        terminate_last_line(self._records_path)
+        if os.path.exists(self._failed_path):
+            with open(self._failed_path, 'r') as f:
+                self.failed = set(line.strip() for line in f if line.strip())
+            terminate_last_line(self._failed_path)
+        self._frames = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, uri):
+        return uri in self.records
+
+    def __repr__(self):
+        return f"ExtractionStore ({len(self)} tracks, {self.n_frames} frames, {len(self.failed)} failed at {self.path})"
+
+    def append(self, uri, result):
+        """
+        Adds the features of a track. Its frames are written before its record, so a record always has its frames
+        :param uri: Track uri
+        :param result: Dict returned by extract_track
+        """
+        frames = np.ascontiguousarray(result['frames'], dtype=np.float32)
+        with open(self._frames_path, 'ab') as f:
+            f.write(frames.tobytes())
+        record = {'uri': uri, 'offset': self.n_frames, 'n_frames': len(frames),
+                  'hpcp': [float(value) for value in result['hpcp']], 'key': result['key'],
+                  'key_strength': result['key_strength'], 'tempo': result['tempo'],
+                  'danceability': result['danceability']}
+        with open(self._records_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.records[uri] = record
+        self.n_frames += len(frames)
+        self._frames = None
+
+    def append_failed(self, uri):
+        """
+        Records a preview that could not be analysed, so the next runs skip it
+        :param uri: Track uri
+        """
+        with open(self._failed_path, 'a') as f:
+            f.write(uri + '\n')
+        self.failed.add(uri)
+
+    def clear_failed(self):
+        """
+        Forgets the failed previews, so the next run tries them again
+        """
+        if os.path.exists(self._failed_path):
+            os.remove(self._failed_path)
+        self.failed = set()
+
+    def frames(self, uri):
+        """
+        Frame HPCPs of a track, read from a memory map of frames.f32
+        :return: Tx12 float32 array, starting at A
+        """
+        record = self.records[uri]
+        if self._frames is None:
+            self._frames = np.memmap(self._frames_path, dtype=np.float32, mode='r', shape=(self.n_frames, 12)) \
+                if self.n_frames else np.empty((0, 12), dtype=np.float32)
+        return self._frames[record['offset']:record['offset'] + record['n_frames']]
+
+    def to_feature_store(self, path):
+        """
+        Writes the track-level features as a FeatureStore, the replacement of spoty_hfeats.json and spoty_hpcps.npy
+        :param path: Directory of the FeatureStore
+        :return: The opened FeatureStore
+        """
+        records = list(self.records.values())
+        return FeatureStore.write(path, [record['uri'] for record in records],
+                                  np.array([record['hpcp'] for record in records], dtype=np.float32).reshape(-1, 12),
+                                  [KEY_CODES.get(record['key'], UNKNOWN_KEY) for record in records],
+                                  [record['tempo'] for record in records],
+                                  [record['danceability'] for record in records])
+
+
+def extract_previews(previews, store, workers=None, progress=None):
+    """
+    Extracts the features of the previews that are not in the store yet, nor failed in a previous run
+    :param previews: Dict of audio paths by uri, e.g. from utils.embeddings.preview_files
+    :param store: ExtractionStore the results are appended to
+    :param workers: Number of processes, defaults to the CPU count
+    :param progress: Optional wrapper of the iterable of tracks, e.g. tqdm
+    :return: List of the uris that could not be analysed in this run, also added to store.failed
+    """
+    if es is None:
+        raise ImportError("The extraction needs essentia")
+    uris = [uri for uri in previews if uri not in store and uri not in store.failed]
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        bar = progress(total=len(uris)) if progress is not None else None
+        # Submitted in windows, so the frames of finished tracks do not pile up in memory
+        for start in range(0, len(uris), MAX_PENDING):
+            futures = {executor.submit(extract_track, previews[uri]): uri for uri in uris[start:start + MAX_PENDING]}
+            for future in as_completed(futures):
+                result = future.result()
+                if result is None:
+                    failed.append(futures[future])
+                    store.append_failed(futures[future])
+                else:
+                    store.append(futures[future], result)
+                if bar is not None:
+                    bar.update()
+        if bar is not None:
+            bar.close()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--previews', required=True, help='Directory with the <uri>.mp3 previews')
+    parser.add_argument('--out', required=True, help='Directory of the extraction store')
+    parser.add_argument('--features', default=None, help='Also write the track features as a FeatureStore here')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to the CPU count')
+    parser.add_argument('--retry-failed', action='store_true', help='Try again the previews that failed before')
+    args = parser.parse_args(argv)
+    store = ExtractionStore(args.out)
+    if args.retry_failed:
+        store.clear_failed()
+    failed = extract_previews(preview_files(args.previews), store, args.workers, progress=tqdm)
+    print(store)
+    if failed:
+        print(f"{len(failed)} previews could not be analysed, e.g. {failed[0]}, see {store._failed_path}")
+    if args.features is not None:
+        print(store.to_feature_store(args.features))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import json
+import os
+import zlib
+from os.path import join as pjoin
+
+import numpy as np
+
+from utils.distances import KEY_CODES, UNKNOWN_KEY, TrackFeatures
+
+# Columns of the store and the dtype they are saved with
+COLUMNS = {'hpcp': np.float32,
+           'key': np.int8,
+           'tempo': np.float32,
+           'danceability': np.float32}
+
+
+def _uri_hash(uri):
+    return zlib.crc32(uri)
+
+
+class FeatureStore:
+    """
+    Indexed, memory-mapped store of track features. A directory holds one .npy file per column, the track uris
+    and an open addressing hash table from uri to row, so lookups are O(1) and nothing is parsed at startup.
+    """
+    def __init__(self, path):
+        """
+        Opens an existing store
+        :param path: Directory of the store, as written by FeatureStore.write
+        """
+        with open(pjoin(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.uris = np.load(pjoin(path, 'uris.npy'), mmap_mode='r')
+        self.index = np.load(pjoin(path, 'index.npy'), mmap_mode='r')
+        self.columns = {name: np.load(pjoin(path, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+        self._mask = len(self.index) - 1
+
+    def __len__(self):
+        return len(self.uris)
+
+    def __contains__(self, uri):
+        return self._find(uri) >= 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __repr__(self):
+        return f"FeatureStore ({len(self)} tracks at {self.path})"
+
+    def _find(self, uri):
+        uri = uri.encode() if isinstance(uri, str) else uri
+        slot = _uri_hash(uri) & self._mask
+        while True:
+            row = self.index[slot]
+            if row < 0:
+                return -1
+            if self.uris[row] == uri:
+                return int(row)
+            slot = (slot + 1) & self._mask
+
+    def row(self, uri):
+        """
+        Row of a track in the store
+        :param uri: Track uri
+        :return: The row index
+        """
+        row = self._find(uri)
+        if row < 0:
+            raise KeyError(uri)
+        return row
+
+    def rows(self, uris):
+        """
+        Rows of many tracks in the store
+        :param uris: Iterable of track uris
+        :return: Integer array with the row index of each uri
+        """
+        return np.array([self.row(uri) for uri in uris], dtype=np.int64)
+
+    def gather(self, uris):
+        """
+        Features of a set of tracks, only the requested rows are read from disk
+        :param uris: List of track uris, e.g. the tracks of a playlist
+        :return: TrackFeatures of the tracks, in the given order
+        """
+        rows = self.rows(uris)
+        return TrackFeatures(list(uris), self.columns['key'][rows], self.columns['hpcp'][rows])
+
+    @classmethod
+    def write(cls, path, uris, hpcp, key, tempo, danceability):
+        """
+        Writes a new store
+        :param path: Directory of the store, created if needed
+        :param uris: N track uris
+        :param hpcp: Nx12 hpcps
+        :param key: N key codes (see utils.distances.KEY_CODES)
+        :param tempo: N tempos
+        :param danceability: N danceabilities
+        :return: The opened FeatureStore
+        """
+        uris = np.array([uri.encode() if isinstance(uri, str) else uri for uri in uris], dtype=bytes)
+        values = {'hpcp': hpcp, 'key': key, 'tempo': tempo, 'danceability': danceability}
+        for name, column in values.items():
+            if len(column) != len(uris):
+                raise ValueError(f"Column '{name}' has {len(column)} rows but there are {len(uris)} uris")
+
+        # Open addressing table with a load factor of at most 0.5
+        size = 1 << max(1, int(2 * len(uris) - 1).bit_length())
+        index = np.full(size, -1, dtype=np.int64 if len(uris) >= 2 ** 31 else np.int32)
+        for row, uri in enumerate(uris):
+            slot = _uri_hash(uri) & (size - 1)
+            while index[slot] >= 0:
+                if uris[index[slot]] == uri:
+                    raise ValueError(f"Duplicated uri {uri.decode()}")
+                slot = (slot + 1) & (size - 1)
+            index[slot] = row
+
+        os.makedirs(path, exist_ok=True)
+        np.save(pjoin(path, 'uris.npy'), uris)
+        np.save(pjoin(path, 'index.npy'), index)
+        for name, dtype in COLUMNS.items():
+            np.save(pjoin(path, name + '.npy'), np.asarray(values[name], dtype=dtype))
+        # The metadata is written last, a store without it is incomplete
+        with open(pjoin(path, 'meta.json'), 'w') as f:
+            json.dump({'n_tracks': len(uris), 'columns': list(COLUMNS)}, f)
+        return cls(path)
+
+    @classmethod
+    def from_legacy(cls, path, hfeats_path='spoty_hfeats.json', hpcps_path='spoty_hpcps.npy'):
+        """
+        Builds a store from spoty_hfeats.json and spoty_hpcps.npy, whose rows are aligned by order
+        :param path: Directory of the new store
+        :param hfeats_path: Json with the tempo, danceability and key of each track uri
+        :param hpcps_path: Nx12 hpcps, in the same order as hfeats_path
+        :return: The opened FeatureStore
+        """
+        with open(hfeats_path, 'r') as f:
+            hfeats = json.load(f)
+        hpcp = np.load(hpcps_path)
+        if len(hpcp) != len(hfeats):
+            raise ValueError(f"{hpcps_path} has {len(hpcp)} rows but {hfeats_path} has {len(hfeats)} tracks")
+        uris = list(hfeats)
+        key = [KEY_CODES.get(hfeats[uri].get('key'), UNKNOWN_KEY) for uri in uris]
+        tempo = [hfeats[uri].get('tempo', np.nan) for uri in uris]
+        danceability = [hfeats[uri].get('danceability', np.nan) for uri in uris]
+        return cls.write(path, uris, hpcp, key, tempo, danceability)
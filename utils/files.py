@@ -0,0 +1,17 @@
+"""
+Helpers of the append-only files written by the stores and checkpoints of the utils package.
+"""
+import os
+
+
+def terminate_last_line(path):
+    """
+    Ends an append-only text file with a newline. A crash while writing can leave a partial last line, the next
+    lines must not be appended to it
+    :param path: The file, nothing is done if it does not exist or is empty
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
@@ -0,0 +1,190 @@
+"""
+Index of the Million Playlist Dataset slices (mpd.slice.<start>-<end>.json).
+
+A single parallel pass over the slices records the byte range of every playlist in its slice file, with its number
+of followers and tracks, and keeps the top-k playlists by followers. Playlists are then read with a seek, without
+parsing their slice:
+
+    python -m utils.mpd_index --data-path spotify_million_playlist_dataset/data --out spotify_data/mpd_index --top 2000
+"""
+import argparse
+import heapq
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join as pjoin
+
+import numpy as np
+from tqdm import tqdm
+
+# One row per playlist
+INDEX_DTYPE = np.dtype([('pid', np.int32),
+                        ('slice', np.int16),
+                        ('offset', np.int64),
+                        ('length', np.int32),
+                        ('num_followers', np.int32),
+                        ('num_tracks', np.int16)])
+
+_separator = re.compile(r'[\s,]*')
+
+
+def slice_files(data_path):
+    """
+    Slice files of a directory, sorted by their first pid
+    """
+    files = [file for file in os.listdir(data_path) if file.startswith('mpd.slice.') and file.endswith('.json')]
+    return sorted(files, key=lambda file: int(file.split('.')[2].split('-')[0]))
+
+
+def index_slice(path, slice_id, k):
+    """
+    Indexes a slice file, in a worker process
+    :param path: Slice file
+    :param slice_id: Position of the slice in the index
+    :param k: Number of playlists kept in the top-k by followers
+    :return: A tuple with the index rows of the slice and its top-k as a heap of (num_followers, pid)
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    text = raw.decode('utf-8')
+    ascii_only = len(text) == len(raw)
+    decoder = json.JSONDecoder()
+
+    rows, top = [], []
+    position = text.index('[', text.index('"playlists"')) + 1
+    byte_position = position if ascii_only else len(text[:position].encode('utf-8'))
+    while True:
+        start = _separator.match(text, position).end()
+        byte_position += start - position  # the separators are ascii
+        if text[start] == ']':
+            break
+        playlist, position = decoder.raw_decode(text, start)
+        length = position - start if ascii_only else len(text[start:position].encode('utf-8'))
+        rows.append((playlist['pid'], slice_id, byte_position, length, playlist['num_followers'],
+                     playlist['num_tracks']))
+        byte_position += length
+        entry = (playlist['num_followers'], playlist['pid'])
+        if len(top) < k:
+            heapq.heappush(top, entry)
+        elif entry > top[0]:
+            heapq.heapreplace(top, entry)
+    return np.array(rows, dtype=INDEX_DTYPE), top
+
+
+def build_index(data_path, out_path, k=2000, workers=None, progress=None):
+    """
+    Indexes all the slices of the dataset in parallel
+    :param data_path: Directory with the slice files
+    :param out_path: Directory where the index is written
+    :param k: Number of playlists kept in the top-k by followers
+    :param workers: Number of processes, defaults to the CPU count
+    :param progress: Optional wrapper of the iterable of slices, e.g. tqdm
+    :return: The opened MPDIndex
+    """
+    files = slice_files(data_path)
+    paths = [pjoin(data_path, file) for file in files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(index_slice, paths, range(len(files)), [k] * len(files))
+        results = list(progress(results, total=len(files)) if progress is not None else results)
+
+    index = np.concatenate([rows for rows, _ in results])
+    index = index[np.argsort(index['pid'], kind='stable')]
+    top = heapq.nlargest(k, (entry for _, heap in results for entry in heap))
+
+    os.makedirs(out_path, exist_ok=True)
+    np.save(pjoin(out_path, 'index.npy'), index)
+    np.save(pjoin(out_path, 'top_pids.npy'), np.array([pid for _, pid in top], dtype=np.int32))
+    # The metadata is written last, an index without it is incomplete
+    with open(pjoin(out_path, 'meta.json'), 'w') as f:
+        json.dump({'data_path': os.path.abspath(data_path), 'slices': files, 'k': k}, f)
+    return MPDIndex(out_path)
+
+
+class MPDIndex:
+    """
+    Playlists of the dataset by pid, read from their byte range in the slice files
+    """
+    def __init__(self, path, data_path=None):
+        """
+        Opens an index written by build_index
+        :param path: Directory of the index
+        :param data_path: Directory with the slice files, if it moved since the index was built
+        """
+        with open(pjoin(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.data_path = data_path or self.meta['data_path']
+        self.slices = self.meta['slices']
+        self.index = np.load(pjoin(path, 'index.npy'), mmap_mode='r')
+        self.top_pids = np.load(pjoin(path, 'top_pids.npy'))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, column):
+        return self.index[column]
+
+    def __repr__(self):
+        return f"MPDIndex ({len(self)} playlists in {len(self.slices)} slices at {self.path})"
+
+    def _rows(self, pids):
+        pids = np.asarray(pids)
+        rows = np.searchsorted(self.index['pid'], pids)
+        found = rows < len(self.index)
+        found[found] = self.index['pid'][rows[found]] == pids[found]
+        if not np.all(found):
+            raise KeyError(pids[~found].tolist())
+        return rows
+
+    def top(self, k=None):
+        """
+        Pids of the k playlists with more followers (at most the k used to build the index)
+        """
+        return self.top_pids[:k]
+
+    def load_playlist(self, pid):
+        """
+        Playlist of a pid, as in the slice file
+        """
+        return self.load_playlists([pid])[0]
+
+    def load_playlists(self, pids):
+        """
+        Playlists of many pids. Each slice file is opened once and read in offset order
+        :param pids: Iterable of pids
+        :return: List of playlists, in the given order
+        """
+        rows = self._rows(list(pids))
+        playlists = [None] * len(rows)
+        order = np.lexsort((self.index['offset'][rows], self.index['slice'][rows]))
+        handle, current = None, None
+        try:
+            for position in order:
+                entry = self.index[rows[position]]
+                if entry['slice'] != current:
+                    if handle is not None:
+                        handle.close()
+                    current = entry['slice']
+                    handle = open(pjoin(self.data_path, self.slices[current]), 'rb')
+                handle.seek(int(entry['offset']))
+                playlists[position] = json.loads(handle.read(int(entry['length'])))
+        finally:
+            if handle is not None:
+                handle.close()
+        return playlists
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-path', required=True, help='Directory with the mpd.slice.*.json files')
+    parser.add_argument('--out', required=True, help='Directory where the index is written')
+    parser.add_argument('--top', type=int, default=2000, help='Number of playlists kept in the top-k by followers')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to the CPU count')
+    args = parser.parse_args(argv)
+    index = build_index(args.data_path, args.out, k=args.top, workers=args.workers, progress=tqdm)
+    print(index)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,21 @@
+import os
+
 import numpy as np
+
 #https://github.com/migperfer/harmonic_compatibility/blob/d69b504fd6730f99b8a5a2cc1aa0bcb7ea9c8ae3/harmonic_compatibility/consonance/harmonicity/peter_harmonicity/harmonicity.py
 eps = np.finfo(float).eps
 
+# Number of distinct pitch-class sets of the 12 integer pitch classes
+N_PC_SETS = 2 ** 12
+
+# Sampling of the pitch class circle used by milne_pc_spectrum
+N_PC_BINS = 1200
+
+_template = None
+_template_rfft = None
+_ph_table = None
+
+
 def transform_to_pc(freqs):
     """
     Converts between frequency to pitch class (continuous)
@@ -9,6 +23,8 @@ def transform_to_pc(freqs):
     :return: Pitch class for each frequency
     """
     return (9 + 12*np.log2(eps + (freqs/440.0))) % 12
+
+
 def milne_pc_spectrum(X):
     """
     Calculates the milne pc spectrum.
@@ -19,6 +35,8 @@ def milne_pc_spectrum(X):
     pc_spec = perceptual_weight(np.linspace(0, 12, 1200), X)
     pc_spec /= 100
     return pc_spec
+
+
 def perceptual_weight(pc, x, rho=0.75, sigma=0.0683):
     """
     Returns the perceptual weight for pc, given the set x of pitches. Pitch class spectrum
@@ -39,6 +57,8 @@ def perceptual_weight(pc, x, rho=0.75, sigma=0.0683):
 
     weighted_contribution = np.sum(exppart * weights_harmonics, axis=0)
     return weighted_contribution
+
+
 def pc_harmonics(pc, n_harmonics=12):
     """
     Get the pitch classes harmonics given a pitch class set
@@ -48,6 +68,8 @@ def pc_harmonics(pc, n_harmonics=12):
     """
     pc = np.array(pc)
     return np.mod(pc[:, np.newaxis] + 12 * np.log2(np.arange(1, n_harmonics + 1)), 12)
+
+
 def pc_distance(pc1, pc2):
     """
     Pitch class distance between pc1 and pc2. One of them can be a numpy array.
@@ -71,10 +93,256 @@ def h_contribution(pc, l, px, sigma=0.0683):
     distances = pc_distance(pc, px)
     t_return = const * np.exp(-0.5 * np.square(distances / sigma))
     return np.sum(t_return)
+
+
+def pc_template():
+    """
+    Milne pc spectrum of a single pitch class, used as template by ph_harmon. Computed once per process.
+    :return: The template spectrum
+    """
+    global _template
+    if _template is None:
+        _template = milne_pc_spectrum([0])
+    return _template
+
+
 def ph_harmon(X):
-    template = milne_pc_spectrum([0])
+    template = pc_template()
     all_pob = np.correlate(X, np.concatenate([template, template]), mode='valid')
     all_pob = all_pob / (np.linalg.norm(X) * np.linalg.norm(template))
     all_pob = all_pob[:-1]
     q_normalized = all_pob / (np.sum(all_pob))
     return np.sum(q_normalized * np.log2(eps + (q_normalized * len(all_pob))))
+
+
+def chord_to_mask(chord):
+    """
+    Bitmask of a pitch-class set, bit p being set when pitch class p is in the chord
+    :param chord: Iterable of integer pitch classes in [0, 12)
+    :return: The bitmask, an int in [0, 4096)
+    """
+    mask = 0
+    for pc in np.unique(np.round(chord).astype(int) % 12):
+        mask |= 1 << int(pc)
+    return mask
+
+
+def mask_to_chord(mask):
+    """
+    Pitch-class set of a bitmask, the inverse of chord_to_mask
+    :param mask: The bitmask
+    :return: Sorted list of the pitch classes in the chord
+    """
+    return [pc for pc in range(12) if (int(mask) >> pc) & 1]
+
+
+def chord_masks(chords):
+    """
+    Bitmasks of many pitch-class sets. Bitmasks are not accepted, they go to ph_harmon_masks directly
+    :param chords: Mx12 boolean array of pitch-class membership, MxK integer array with a chord of K pitch classes
+        per row, or an iterable of chords. A single chord, e.g. [0, 4, 7], is rejected instead of being read as three
+        one-note chords, it goes in a list or a 1xK array
+    :return: Integer array of bitmasks, one per chord
+    """
+    if isinstance(chords, np.ndarray):
+        if chords.ndim < 2:
+            raise ValueError(f"Expected one chord per row, got an array of shape {chords.shape}")
+        if chords.dtype == bool and chords.shape[-1] == 12:
+            return np.sum(chords * (1 << np.arange(12)), axis=-1)
+        if np.issubdtype(chords.dtype, np.integer):
+            return np.bitwise_or.reduce(1 << (chords % 12), axis=-1)
+    chords = list(chords)
+    if any(np.ndim(chord) == 0 for chord in chords):
+        raise ValueError("Expected an iterable of chords, got a single chord")
+    return np.array([chord_to_mask(chord) for chord in chords], dtype=int)
+
+
+def build_ph_table():
+    """
+    Computes ph_harmon of the milne pc spectrum of every pitch-class set. The empty set has no harmonicity (nan).
+    :return: Array of length 4096 indexed by the chord bitmask
+    """
+    membership = (np.arange(N_PC_SETS)[:, np.newaxis] >> np.arange(12)) & 1
+    pitch_sets = np.broadcast_to(np.arange(12, dtype=float), membership.shape)
+    with np.errstate(invalid='ignore'):
+        table = ph_harmon_pitch_sets(pitch_sets, membership)
+    table[0] = np.nan
+    return table
+
+
+def ph_table(path=None):
+    """
+    Lookup table of ph_harmon for every pitch-class set. It is built on first use and kept for the process.
+    :param path: Optional .npy file. If it exists the table is loaded from it, otherwise the built table is saved there
+    :return: Array of length 4096 indexed by the chord bitmask
+    """
+    global _ph_table
+    if _ph_table is None:
+        if path is not None and os.path.exists(path):
+            _ph_table = np.load(path)
+        else:
+            _ph_table = build_ph_table()
+            if path is not None:
+                save_ph_table(path)
+    return _ph_table
+
+
+def set_ph_table(table):
+    """
+    Uses a lookup table built elsewhere, e.g. by the parent of a worker process, instead of building it
+    :param table: Array of length 4096 returned by ph_table
+    """
+    global _ph_table
+    if len(table) != N_PC_SETS:
+        raise ValueError(f"The table must have {N_PC_SETS} entries, got {len(table)}")
+    _ph_table = np.asarray(table)
+
+
+def save_ph_table(path):
+    """
+    Persists the lookup table, building it if needed. It is written to a temporary file that replaces path, so
+    concurrent readers never see a partly written table
+    :param path: The .npy file to write
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, ph_table())
+    os.replace(tmp_path, path)
+
+
+def ph_harmon_chords(chords, table_path=None):
+    """
+    Harmonicity of many integer pitch-class sets, as ph_harmon(milne_pc_spectrum(chord)) but gathered from ph_table
+    :param chords: Mx12 boolean array of pitch-class membership, MxK integer array of pitch classes, or an iterable
+        of chords (see chord_masks)
+    :param table_path: Optional .npy file to load/persist the lookup table
+    :return: Array with the harmonicity of each chord
+    """
+    return ph_table(table_path)[chord_masks(chords)]
+
+
+def ph_harmon_masks(masks, table_path=None):
+    """
+    Harmonicity of pitch-class sets given as bitmasks (see chord_to_mask), gathered from ph_table
+    :param masks: Integer array of bitmasks in [0, 4096), of any shape
+    :param table_path: Optional .npy file to load/persist the lookup table
+    :return: Array of the shape of masks with the harmonicity of each chord
+    """
+    masks = np.asarray(masks)
+    if not np.issubdtype(masks.dtype, np.integer):
+        raise TypeError(f"Bitmasks must be integers, got dtype {masks.dtype}")
+    if masks.size and (masks.min() < 0 or masks.max() >= N_PC_SETS):
+        raise ValueError(f"Bitmasks must be in [0, {N_PC_SETS})")
+    return ph_table(table_path)[masks]
+
+
+def template_rfft():
+    """
+    Real FFT of the ph_harmon template. Computed once per process.
+    :return: The rfft of pc_template()
+    """
+    global _template_rfft
+    if _template_rfft is None:
+        _template_rfft = np.fft.rfft(pc_template())
+    return _template_rfft
+
+
+def _pad_pitch_sets(pitch_sets, weights=None):
+    """
+    Stacks pitch sets of different sizes in a single array, padding with zero weight pitches
+    :param pitch_sets: BxK array or iterable of B pitch sets
+    :param weights: Optional weights with the same layout as pitch_sets. Defaults to 1 for every pitch
+    :return: BxK pitch classes and BxK weights
+    """
+    if isinstance(pitch_sets, np.ndarray) and pitch_sets.ndim == 2:
+        pitches = pitch_sets.astype(float)
+        levels = np.ones(pitches.shape) if weights is None else np.broadcast_to(weights, pitches.shape).astype(float)
+        return pitches, levels
+    pitch_sets = [np.atleast_1d(np.asarray(x, dtype=float)) for x in pitch_sets]
+    if weights is None:
+        weights = [np.ones(len(x)) for x in pitch_sets]
+    size = max([len(x) for x in pitch_sets] + [1])
+    pitches = np.zeros((len(pitch_sets), size))
+    levels = np.zeros((len(pitch_sets), size))
+    for i, (x, w) in enumerate(zip(pitch_sets, weights)):
+        pitches[i, :len(x)] = x
+        levels[i, :len(x)] = w
+    return pitches, levels
+
+
+def milne_pc_spectra(pitch_sets, weights=None, rho=0.75, sigma=0.0683, chunk_size=256):
+    """
+    Milne pc spectrum of many weighted pitch sets at once. With unit weights, row b equals
+    milne_pc_spectrum(pitch_sets[b]). Each harmonic only contributes to the bins within 10 sigma of it, the
+    rest of its gaussian is below double precision of the peak.
+    :param pitch_sets: BxK array or iterable of B pitch sets, with continuous pitch classes in [0, 12)
+    :param weights: Optional weight (level) of each pitch, same layout as pitch_sets. Defaults to 1
+    :param chunk_size: Number of pitch sets computed at once
+    :return: Bx1200 array with the spectra
+    """
+    pitches, levels = _pad_pitch_sets(pitch_sets, weights)
+    n_sets = len(pitches)
+    # linspace(0, 12, 1200) holds 1199 distinct points of the circle, the last bin repeats the first one
+    n_points = N_PC_BINS - 1
+    step = 12 / n_points
+    width = int(np.ceil(10 * sigma / step))
+    offsets = np.arange(-width, width + 1)
+    n_unwrapped = n_points + 2 * width + 1
+    harmonic_weights = np.power(np.arange(1, 13), rho) / (sigma * np.sqrt(2 * np.pi))
+
+    spectra = np.empty((n_sets, N_PC_BINS))
+    for start in range(0, n_sets, chunk_size):
+        stop = min(start + chunk_size, n_sets)
+        harmonics = np.mod(pitches[start:stop, :, np.newaxis] + 12 * np.log2(np.arange(1, 13)), 12)
+        amplitudes = levels[start:stop, :, np.newaxis] * harmonic_weights
+        harmonics = harmonics.reshape(stop - start, -1)
+        amplitudes = amplitudes.reshape(stop - start, -1)
+
+        # Bins around each harmonic, without wrapping around the circle: bin u is at u * step
+        nearest = np.round(harmonics / step)
+        distances = (nearest * step - harmonics)[:, :, np.newaxis] + offsets * step
+        contributions = amplitudes[:, :, np.newaxis] * np.exp(-0.5 * np.square(distances / sigma))
+        bins = nearest.astype(int)[:, :, np.newaxis] + (offsets + width)
+        bins += np.arange(stop - start)[:, np.newaxis, np.newaxis] * n_unwrapped
+        unwrapped = np.bincount(bins.ravel(), contributions.ravel(), minlength=(stop - start) * n_unwrapped)
+        unwrapped = unwrapped.reshape(stop - start, n_unwrapped)
+
+        # Fold the bins that went past either end of the circle
+        chunk = spectra[start:stop]
+        chunk[:, :n_points] = unwrapped[:, width:width + n_points]
+        chunk[:, :width + 1] += unwrapped[:, width + n_points:]
+        chunk[:, n_points - width:n_points] += unwrapped[:, :width]
+        chunk[:, n_points] = chunk[:, 0]
+    spectra /= 100
+    return spectra
+
+
+def ph_harmon_batch(X):
+    """
+    ph_harmon of many spectra at once. The circular correlation with the template is computed with a real FFT.
+    :param X: Bx1200 array of pc spectra
+    :return: Array with the harmonicity of each spectrum
+    """
+    X = np.atleast_2d(X)
+    n_bins = X.shape[1]
+    all_pob = np.fft.irfft(np.conj(np.fft.rfft(X, axis=1)) * template_rfft(), n=n_bins, axis=1)
+    all_pob = all_pob / (np.linalg.norm(X, axis=1, keepdims=True) * np.linalg.norm(pc_template()))
+    q_normalized = all_pob / np.sum(all_pob, axis=1, keepdims=True)
+    return np.sum(q_normalized * np.log2(eps + (q_normalized * n_bins)), axis=1)
+
+
+def ph_harmon_pitch_sets(pitch_sets, weights=None, chunk_size=256):
+    """
+    Harmonicity of many weighted pitch sets, as ph_harmon(milne_pc_spectrum(pitch_set)) for each of them
+    :param pitch_sets: BxK array or iterable of B pitch sets, with continuous pitch classes in [0, 12)
+    :param weights: Optional weight (level) of each pitch, same layout as pitch_sets. Defaults to 1
+    :param chunk_size: Number of pitch sets computed at once
+    :return: Array with the harmonicity of each pitch set
+    """
+    pitches, levels = _pad_pitch_sets(pitch_sets, weights)
+    harmonicity = np.empty(len(pitches))
+    for start in range(0, len(pitches), chunk_size):
+        stop = start + chunk_size
+        spectra = milne_pc_spectra(pitches[start:stop], levels[start:stop], chunk_size=chunk_size)
+        harmonicity[start:stop] = ph_harmon_batch(spectra)
+    return harmonicity
@@ -0,0 +1,258 @@
+"""
+Computes the harmonic reorderings of a pool of playlists on a process pool.
+
+Every (playlist, method) job is checkpointed to an append-only jsonl file as soon as it finishes, so an interrupted
+run continues where it stopped. When a playlist changed since its job was checkpointed it is solved again, with
+--incremental from its previous order and distance matrix. The distance matrices are kept next to the checkpoint,
+one .npy file per job in '<checkpoint>.d/', and the records only name them. The output has the format read by
+app/main.py:
+
+    python -m utils.reorder --playlists spotify_data/top1000_playlists.json --features spoty_features \
+        --checkpoint reorderings.jsonl --output reorderings.json --topn 10 --min-keys 5
+"""
+import argparse
+import json
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+from utils.distances import distance_matrix, update_distance_matrix
+from utils.features import FeatureStore
+from utils.files import terminate_last_line
+from utils.ph_harm import ph_table, set_ph_table
+from utils.sequencing import solve, solve_incremental
+
+DEFAULT_METHODS = ['binary', 'circle', 'tiv', 'ph']
+# Suffix of the directory, next to the checkpoint, with the distance matrices of the jobs
+MATRIX_DIR_SUFFIX = '.d'
+
+_store = None
+
+
+def _init_worker(features_path, table=None):
+    global _store
+    _store = FeatureStore(features_path)
+    # Harmonicity table loaded (or built) once by the parent, instead of once per worker or per job
+    if table is not None:
+        set_ph_table(table)
+
+
+def resequence(method, features, previous_uris, previous_matrix, previous_permutation, time_budget=None, seed=None):
+    """
+    Reorders an edited playlist from its previous version: only the distances of the added tracks are computed and
+    the previous order is repaired and improved with local search, instead of solving from scratch
+    :param method: Distance method, see utils.distances.METHODS
+    :param features: TrackFeatures of the edited playlist, the first track is kept as the first track
+    :param previous_uris: Track uris of the previous version
+    :param previous_matrix: Distance matrix of the previous version
+    :param previous_permutation: Order of the previous version, as indices of previous_uris
+    :param time_budget: Optional time limit in seconds for the local search
+    :param seed: Seed of the solver
+    :return: A tuple with the distance matrix, the permutation and its distance
+    """
+    matrix, previous = update_distance_matrix(method, previous_matrix, previous_uris, features)
+    # Previous indices to new indices, -1 for the removed tracks
+    moved = np.full(len(previous_uris), -1, dtype=np.int64)
+    moved[previous[previous >= 0]] = np.flatnonzero(previous >= 0)
+    permutation, distance = solve_incremental(matrix, moved[np.asarray(previous_permutation, dtype=np.int64)],
+                                              time_budget=time_budget, seed=seed)
+    return matrix, permutation, distance
+
+
+def matrix_name(pid, method, uris):
+    """
+    File name of the distance matrix of a job. It changes with the uris, so the matrix of a checkpointed version is
+    not overwritten before the record of the new version is written
+    """
+    return f"{pid}-{method}-{zlib.crc32(json.dumps(list(uris)).encode()):08x}.npy"
+
+
+def _save_matrix(path, matrix):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, matrix)
+    os.replace(tmp_path, path)
+
+
+def solve_job(pid, uris, method, matrix_dir, time_budget=None, previous=None):
+    """
+    Reorders a playlist with a method, in a worker process
+    :param pid: Playlist id
+    :param uris: Track uris of the playlist, the first one is kept as the first track
+    :param method: Distance method, see utils.distances.METHODS
+    :param matrix_dir: Directory where the distance matrix is saved, see matrix_name
+    :param time_budget: Optional time limit in seconds for the solver
+    :param previous: Checkpoint record of a previous version of the playlist, to reorder it incrementally
+    :return: Checkpoint record with the permutation, its distance, the uris and the file name of the distance matrix
+    """
+    features = _store.gather(uris)
+    seed = zlib.crc32(f'{pid}/{method}'.encode())
+    previous_path = None
+    if previous is not None and 'matrix' in previous:
+        previous_path = os.path.join(matrix_dir, previous['matrix'])
+    if previous_path is not None and os.path.exists(previous_path):
+        matrix, permutation, distance = resequence(method, features, previous['uris'], np.load(previous_path),
+                                                   previous['permutation'], time_budget=time_budget, seed=seed)
+    else:
+        matrix = distance_matrix(method, features)
+        permutation, distance = solve(matrix, time_budget=time_budget, seed=seed)
+    name = matrix_name(pid, method, uris)
+    _save_matrix(os.path.join(matrix_dir, name), matrix)
+    return {'pid': pid, 'method': method, 'permutation': permutation, 'distance': distance, 'uris': list(uris),
+            'matrix': name}
+
+
+def read_checkpoint(path):
+    """
+    Reads the finished jobs of a checkpoint file. A truncated last line (a crash while writing) is ignored. The
+    distance matrices are not loaded, the records only have their file names
+    :param path: The jsonl checkpoint
+    :return: Dict of records by (pid, method)
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            # Older checkpoints kept the matrices inline, those playlists are solved from scratch if they change
+            if not isinstance(record.get('matrix', ''), str):
+                del record['matrix']
+            records[(record['pid'], record['method'])] = record
+    return records
+
+
+def select_playlists(playlists, store, topn=None, min_keys=None):
+    """
+    Keeps the first topn tracks of each playlist, and the playlists with at least min_keys different keys
+    :param playlists: Dict of playlists by pid, as in top1000_playlists.json
+    :param store: FeatureStore with the features of the tracks
+    :param topn: Number of tracks kept from each playlist, None for all
+    :param min_keys: Minimum number of different keys, None for no filter
+    :return: Dict of the selected playlists by pid
+    """
+    selection = {}
+    for pid, playlist in playlists.items():
+        tracks = playlist['tracks'][:topn]
+        uris = [track['track_uri'] for track in tracks]
+        missing = [uri for uri in uris if uri not in store]
+        if missing:
+            print(f"Skipping playlist {pid}: {len(missing)} tracks have no features", file=sys.stderr)
+            continue
+        if min_keys is not None and len(set(store.gather(uris).keys)) < min_keys:
+            continue
+        selection[pid] = dict(playlist, tracks=tracks)
+    return selection
+
+
+def build_output(selection, records, methods):
+    """
+    Groups the finished jobs by playlist, in the format read by app/main.py
+    :param selection: Dict of the selected playlists by pid
+    :param records: Dict of checkpoint records by (pid, method)
+    :param methods: Methods that every playlist must have to be included
+    :return: List of {'uris', 'playlist', 'options'} entries
+    """
+    result = []
+    for pid, playlist in selection.items():
+        if not all((pid, method) in records for method in methods):
+            continue
+        options = {method: {'permutation': records[(pid, method)]['permutation'],
+                            'distance': records[(pid, method)]['distance']} for method in methods}
+        result.append({'uris': _uris(playlist),
+                       'playlist': playlist,
+                       'options': options})
+    return result
+
+
+def _uris(playlist):
+    return [track['track_uri'] for track in playlist['tracks']]
+
+
+def run(playlists_path, features_path, checkpoint_path, output_path, methods=None, topn=None, min_keys=None,
+        workers=None, time_budget=None, ph_table_path=None, incremental=False):
+    """
+    Solves all the (playlist, method) jobs that are not in the checkpoint yet, or whose playlist changed, and writes
+    the output
+    :param incremental: If True, the changed playlists are reordered from their checkpointed version
+    :return: The output entries
+    """
+    methods = methods or DEFAULT_METHODS
+    with open(playlists_path, 'r') as f:
+        playlists = json.load(f)
+    selection = select_playlists(playlists, FeatureStore(features_path), topn, min_keys)
+
+    records = read_checkpoint(checkpoint_path)
+    jobs = [(pid, method) for pid in selection for method in methods
+            if (pid, method) not in records or records[(pid, method)].get('uris', _uris(selection[pid]))
+            != _uris(selection[pid])]
+    print(f"{len(selection)} playlists, {len(records)} jobs already done, {len(jobs)} to do", file=sys.stderr)
+
+    if jobs:
+        terminate_last_line(checkpoint_path)
+        matrix_dir = checkpoint_path + MATRIX_DIR_SUFFIX
+        os.makedirs(matrix_dir, exist_ok=True)
+        table = ph_table(ph_table_path) if any(method == 'ph' for _, method in jobs) else None
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(features_path, table)) as executor, \
+                open(checkpoint_path, 'a') as checkpoint:
+            futures = {executor.submit(solve_job, pid, _uris(selection[pid]), method, matrix_dir, time_budget,
+                                       records.get((pid, method)) if incremental else None): (pid, method)
+                       for pid, method in jobs}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                pid, method = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    # The other jobs go on, this one is solved again by the next run
+                    print(f"Job of playlist {pid} with {method} failed: {e!r}", file=sys.stderr)
+                    continue
+                checkpoint.write(json.dumps(record) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                previous = records.get((pid, method))
+                records[(pid, method)] = record
+                # The matrix of the replaced version is not referenced anymore
+                if previous is not None and previous.get('matrix') not in (None, record['matrix']):
+                    try:
+                        os.remove(os.path.join(matrix_dir, previous['matrix']))
+                    except FileNotFoundError:
+                        pass
+
+    result = build_output(selection, records, methods)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f, indent=4)
+    os.replace(tmp_path, output_path)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--playlists', required=True, help='Json with the playlists by pid')
+    parser.add_argument('--features', required=True, help='FeatureStore directory')
+    parser.add_argument('--checkpoint', required=True, help='Append-only jsonl with the finished jobs')
+    parser.add_argument('--output', required=True, help='Json written in the format read by app/main.py')
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS, help='Distance methods to solve')
+    parser.add_argument('--topn', type=int, default=None, help='Number of tracks kept from each playlist')
+    parser.add_argument('--min-keys', type=int, default=None, help='Minimum number of different keys per playlist')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to the CPU count')
+    parser.add_argument('--time-budget', type=float, default=None, help='Solver time limit per job in seconds')
+    parser.add_argument('--ph-table', default=None, help='.npy file to load/persist the harmonicity table')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reorder the playlists that changed from their checkpointed order')
+    args = parser.parse_args(argv)
+    run(args.playlists, args.features, args.checkpoint, args.output, methods=args.methods, topn=args.topn,
+        min_keys=args.min_keys, workers=args.workers, time_budget=args.time_budget, ph_table_path=args.ph_table,
+        incremental=args.incremental)
+
+
+if __name__ == '__main__':
+    main()
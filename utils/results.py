@@ -0,0 +1,255 @@
+"""
+Aggregates the listening test responses written by the app (one jsonl file per submission, see app/responses.py).
+
+The files of a local directory or an S3 prefix are read into a columnar table that is saved to a .npz file together
+with the list of files already read, so an update only reads the new submissions. Inharmonic transition rates are
+computed per method (or per method and playlist) with bootstrap confidence intervals:
+
+    python -m utils.results --source s3://my-bucket/ --table results.npz --by method playlist
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as pjoin
+
+import numpy as np
+
+# Columns of the table: the integer columns index the categories of the same name
+COLUMNS = {'submission': np.int32,
+           'method': np.int16,
+           'playlist': np.int32,
+           'user': np.int32,
+           'transition_idx': np.int16,
+           'bad': np.bool_}
+CATEGORIES = ('submission', 'method', 'playlist', 'user')
+# Files read concurrently
+MAX_WORKERS = 16
+# Bootstrap replicates computed at once, bounds the memory to chunk x submissions weights
+BOOTSTRAP_CHUNK = 256
+
+
+def _s3_client():
+    import boto3
+    return boto3.client('s3')
+
+
+def list_source(source, client=None):
+    """
+    Submission files of a results location
+    :param source: Local directory or 's3://bucket/prefix'
+    :param client: Optional boto3 S3 client
+    :return: Dict of a version string (ETag, or mtime and size) by file key
+    """
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        client = client or _s3_client()
+        files = {}
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.jsonl'):
+                    files[item['Key']] = item['ETag']
+        return files
+    files = {}
+    for entry in os.scandir(source):
+        if entry.name.endswith('.jsonl') and entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = f'{stat.st_mtime_ns}-{stat.st_size}'
+    return files
+
+
+def read_source(source, key, client=None):
+    """
+    Records of a submission file, malformed lines are skipped
+    """
+    if source.startswith('s3://'):
+        bucket = source[len('s3://'):].partition('/')[0]
+        client = client or _s3_client()
+        text = client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    else:
+        with open(pjoin(source, key), 'r', encoding='utf-8') as f:
+            text = f.read()
+    records = []
+    for line in text.splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+
+class ResultsTable:
+    """
+    Columnar table with a row per rated transition
+    """
+    def __init__(self):
+        self.columns = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.categories = {name: [] for name in CATEGORIES}
+        self.manifest = {}
+        self._codes = {name: {} for name in CATEGORIES}
+
+    def __len__(self):
+        return len(self.columns['bad'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __repr__(self):
+        return (f"ResultsTable ({len(self)} transitions, {len(self.manifest)} submissions, "
+                f"{len(self.categories['user'])} users)")
+
+    def _code(self, category, value):
+        codes = self._codes[category]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.categories[category].append(value)
+        return codes[value]
+
+    def _encode(self, key, records):
+        # Columns of the records of a submission
+        rows = [record for record in records if record.get('harmonicity') in ('good', 'bad')]
+        submission = self._code('submission', key)
+        return {'submission': np.full(len(rows), submission),
+                'method': [self._code('method', row['method']) for row in rows],
+                'playlist': [self._code('playlist', row['playlist']) for row in rows],
+                'user': [self._code('user', row['user']) for row in rows],
+                'transition_idx': [row['transition_idx'] for row in rows],
+                'bad': [row['harmonicity'] == 'bad' for row in rows]}
+
+    def _drop(self, keys):
+        codes = [self._codes['submission'][key] for key in keys if key in self._codes['submission']]
+        keep = ~np.isin(self.columns['submission'], codes)
+        self.columns = {name: column[keep] for name, column in self.columns.items()}
+
+    def update(self, source, client=None, workers=MAX_WORKERS, progress=None):
+        """
+        Reads the submissions of a results location that are new or changed since the last update, and drops the rows
+        of the submissions that are not there anymore
+        :param source: Local directory or 's3://bucket/prefix'
+        :param client: Optional boto3 S3 client
+        :param workers: Files read concurrently
+        :param progress: Optional wrapper of the iterable of files, e.g. tqdm
+        :return: Number of files read or dropped
+        """
+        if source.startswith('s3://') and client is None:
+            client = _s3_client()
+        files = list_source(source, client)
+        keys = [key for key, version in files.items() if self.manifest.get(key) != version]
+        removed = [key for key in self.manifest if key not in files]
+        if not keys and not removed:
+            return 0
+        self._drop(removed + [key for key in keys if key in self.manifest])
+        for key in removed:
+            del self.manifest[key]
+
+        parts = [self.columns]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            submissions = executor.map(lambda key: read_source(source, key, client), keys)
+            for key, records in zip(keys, progress(submissions) if progress is not None else submissions):
+                parts.append(self._encode(key, records))
+                self.manifest[key] = files[key]
+        self.columns = {name: np.concatenate([np.asarray(part[name], dtype=dtype) for part in parts])
+                        for name, dtype in COLUMNS.items()}
+        return len(keys) + len(removed)
+
+    def save(self, path):
+        """
+        Saves the table, its categories and the manifest of files read to a .npz file
+        """
+        arrays = dict(self.columns)
+        for name in CATEGORIES:
+            arrays['categories_' + name] = np.array(self.categories[name], dtype=str)
+        arrays['manifest'] = np.array(json.dumps(self.manifest))
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Table saved with save(), or an empty table if path does not exist
+        """
+        table = cls()
+        if not os.path.exists(path):
+            return table
+        with np.load(path) as arrays:
+            table.columns = {name: arrays[name] for name in COLUMNS}
+            for name in CATEGORIES:
+                table.categories[name] = arrays['categories_' + name].tolist()
+                table._codes[name] = {value: code for code, value in enumerate(table.categories[name])}
+            table.manifest = json.loads(str(arrays['manifest']))
+        return table
+
+    def groups(self, by=('method',)):
+        """
+        Group of every row
+        :param by: Categories that define the groups, e.g. ('method', 'playlist')
+        :return: A tuple with the group code of each row and the list of group names (tuples of category values)
+        """
+        codes = np.stack([self.columns[name].astype(np.int64) for name in by], axis=1)
+        unique, inverse = np.unique(codes, axis=0, return_inverse=True)
+        names = [tuple(self.categories[name][code] for name, code in zip(by, row)) for row in unique]
+        return inverse.reshape(-1), names
+
+    def inharmonic_rates(self, by=('method',), n_boot=2000, alpha=0.05, seed=None):
+        """
+        Rate of transitions rated as inharmonic per group, with percentile bootstrap confidence intervals.
+        Submissions are resampled as a whole (their ratings are not independent) with Poisson(1) weights, which
+        turns every replicate into a matrix product
+        :param by: Categories that define the groups, e.g. ('method',) or ('method', 'playlist')
+        :param n_boot: Number of bootstrap replicates
+        :param alpha: 1 - confidence level of the intervals
+        :param seed: Seed of the bootstrap
+        :return: List of dicts with the group, the number of bad and rated transitions, the rate and its interval,
+            empty if the table has no rows
+        """
+        if not len(self):
+            return []
+        group, names = self.groups(by)
+        n_groups, n_submissions = len(names), len(self.categories['submission'])
+        # Bad and rated transitions of every submission in every group
+        cell = self.columns['submission'].astype(np.int64) * n_groups + group
+        size = n_submissions * n_groups
+        bad = np.bincount(cell, weights=self.columns['bad'], minlength=size).reshape(n_submissions, n_groups)
+        total = np.bincount(cell, minlength=size).reshape(n_submissions, n_groups).astype(np.float64)
+
+        rng = np.random.default_rng(seed)
+        replicates = np.empty((n_boot, n_groups))
+        for start in range(0, n_boot, BOOTSTRAP_CHUNK):
+            weights = rng.poisson(1., size=(min(BOOTSTRAP_CHUNK, n_boot - start), n_submissions)).astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                replicates[start:start + len(weights)] = (weights @ bad) / (weights @ total)
+        low, high = np.nanquantile(replicates, [alpha / 2, 1 - alpha / 2], axis=0)
+
+        n_bad, n_total = bad.sum(axis=0), total.sum(axis=0)
+        return [{**dict(zip(by, name)), 'bad': int(n_bad[g]), 'transitions': int(n_total[g]),
+                 'rate': n_bad[g] / n_total[g], 'low': low[g], 'high': high[g]} for g, name in enumerate(names)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', required=True, help="Directory or 's3://bucket/prefix' with the responses")
+    parser.add_argument('--table', required=True, help='.npz file of the table, updated incrementally')
+    parser.add_argument('--by', nargs='+', default=['method'], choices=['method', 'playlist', 'user'],
+                        help='Categories that define the groups')
+    parser.add_argument('--n-boot', type=int, default=2000, help='Bootstrap replicates')
+    parser.add_argument('--alpha', type=float, default=0.05, help='1 - confidence level')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the bootstrap')
+    args = parser.parse_args(argv)
+
+    table = ResultsTable.load(args.table)
+    n_changed = table.update(args.source)
+    if n_changed:
+        table.save(args.table)
+    print(f"{n_changed} new, changed or removed submissions, {table}", file=sys.stderr)
+    if not len(table):
+        print("No rated transitions yet")
+    for row in table.inharmonic_rates(tuple(args.by), n_boot=args.n_boot, alpha=args.alpha, seed=args.seed):
+        group = ' / '.join(str(row[name]) for name in args.by)
+        print(f"{group}: {row['rate']:.3f} [{row['low']:.3f}, {row['high']:.3f}] "
+              f"({row['bad']} of {row['transitions']} transitions inharmonic)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+import time
+
+import numpy as np
+
+# Largest playlist solved exactly with Held-Karp. Memory grows as 2^(n-1) * (n-1)
+EXACT_MAX_TRACKS = 20
+# Largest playlist improved with restarted local search. Above it a single descent is run
+LOCAL_SEARCH_MAX_TRACKS = 1000
+# Time budget in seconds used by the heuristics when the caller gives none
+DEFAULT_TIME_BUDGET = 1.0
+# Rough time of a Held-Karp step, which takes n^2 * 2^n of them, to skip it when it cannot finish in the budget
+HELD_KARP_STEP_SECONDS = 1e-8
+# Share of the time budget given to Held-Karp, the rest is kept for the heuristic if it runs out of time
+EXACT_BUDGET_SHARE = 0.5
+
+_IMPROVEMENT_TOLERANCE = 1e-9
+
+
+def path_distance(distance_matrix, permutation):
+    """
+    Cost of visiting the tracks in the order of permutation, without returning to the first one.
+    With distance_matrix[:, 0] = 0 this is the tour distance returned by python_tsp.
+    :param distance_matrix: NxN distance matrix
+    :param permutation: Order of the tracks
+    :return: The distance of the path
+    """
+    permutation = np.asarray(permutation)
+    return float(np.sum(np.asarray(distance_matrix)[permutation[:-1], permutation[1:]]))
+
+
+def _deadline(time_budget):
+    return None if time_budget is None else time.perf_counter() + time_budget
+
+
+def _expired(deadline):
+    return deadline is not None and time.perf_counter() > deadline
+
+
+def _with_free_start(solver, distance_matrix, **kwargs):
+    """
+    Solves the open path with any start track, by starting from a dummy track at zero distance from all others
+    """
+    n = len(distance_matrix)
+    padded = np.zeros((n + 1, n + 1))
+    padded[:n, :n] = distance_matrix
+    permutation, _ = solver(padded, start=n, **kwargs)
+    permutation = permutation[1:]
+    return permutation, path_distance(distance_matrix, permutation)
+
+
+def solve_exact(distance_matrix, start=0, time_budget=None):
+    """
+    Optimal open path with Held-Karp dynamic programming over bitmasks, vectorized by subset size.
+    :param distance_matrix: NxN distance matrix, possibly asymmetric
+    :param start: First track of the path, or None to let the solver choose it
+    :param time_budget: Optional time limit in seconds. TimeoutError is raised when it is exceeded
+    :return: A tuple with the permutation (list starting with start) and its distance
+    """
+    if start is None:
+        return _with_free_start(solve_exact, distance_matrix, time_budget=time_budget)
+    deadline = _deadline(time_budget)
+    distance_matrix = np.asarray(distance_matrix, dtype=np.float64)
+    n = len(distance_matrix)
+    if n <= 2:
+        permutation = [start] + [i for i in range(n) if i != start]
+        return permutation, path_distance(distance_matrix, permutation)
+
+    others = np.array([i for i in range(n) if i != start])
+    m = len(others)
+    costs = distance_matrix[np.ix_(others, others)]
+    n_masks = 1 << m
+    masks = np.arange(n_masks)
+    sizes = np.zeros(n_masks, dtype=np.int8)
+    for bit in range(m):
+        sizes += (masks >> bit) & 1
+
+    # best[mask, j]: cost of the best path from start through the tracks in mask, ending at track j
+    best = np.full((n_masks, m), np.inf)
+    parent = np.full((n_masks, m), -1, dtype=np.int8)
+    best[1 << np.arange(m), np.arange(m)] = distance_matrix[start, others]
+    for size in range(2, m + 1):
+        layer = masks[sizes == size]
+        for j in range(m):
+            subsets = layer[(layer >> j) & 1 == 1]
+            candidates = best[subsets ^ (1 << j)] + costs[:, j]
+            parent[subsets, j] = np.argmin(candidates, axis=1)
+            best[subsets, j] = candidates[np.arange(len(subsets)), parent[subsets, j]]
+        if _expired(deadline):
+            raise TimeoutError(f"Held-Karp did not finish within {time_budget} seconds")
+
+    mask = n_masks - 1
+    last = int(np.argmin(best[mask]))
+    distance = float(best[mask, last])
+    order = []
+    while last >= 0:
+        order.append(last)
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    permutation = [int(start)] + [int(others[j]) for j in reversed(order)]
+    return permutation, distance
+
+
+def held_karp_seconds(n):
+    """
+    Estimated time of solve_exact for n tracks with a fixed start
+    """
+    m = max(n - 1, 1)
+    return m * m * (1 << m) * HELD_KARP_STEP_SECONDS
+
+
+def nearest_neighbour(distance_matrix, start=0):
+    """
+    Greedy path that always moves to the closest track not visited yet
+    :param distance_matrix: NxN distance matrix
+    :param start: First track of the path
+    :return: The permutation as an integer array
+    """
+    n = len(distance_matrix)
+    visited = np.zeros(n, dtype=bool)
+    permutation = np.empty(n, dtype=np.int64)
+    permutation[0] = start
+    visited[start] = True
+    for position in range(1, n):
+        distances = np.where(visited, np.inf, distance_matrix[permutation[position - 1]])
+        permutation[position] = np.argmin(distances)
+        visited[permutation[position]] = True
+    return permutation
+
+
+def _best_two_opt(distance_matrix, permutation):
+    """
+    Best move reversing permutation[i:k + 1], for 1 <= i < k. Returns the gain (negative is better), i and k
+    """
+    n = len(permutation)
+    forward = distance_matrix[permutation[:-1], permutation[1:]]
+    backward = distance_matrix[permutation[1:], permutation[:-1]]
+    forward_sum = np.concatenate(([0], np.cumsum(forward)))
+    backward_sum = np.concatenate(([0], np.cumsum(backward)))
+
+    i = np.arange(1, n)[:, np.newaxis]
+    k = np.arange(1, n)[np.newaxis, :]
+    nxt = np.minimum(k + 1, n - 1)
+    has_next = k < n - 1
+    before = (distance_matrix[permutation[i - 1], permutation[i]] + forward_sum[k] - forward_sum[i]
+              + np.where(has_next, distance_matrix[permutation[k], permutation[nxt]], 0))
+    after = (distance_matrix[permutation[i - 1], permutation[k]] + backward_sum[k] - backward_sum[i]
+             + np.where(has_next, distance_matrix[permutation[i], permutation[nxt]], 0))
+    gain = np.where(k > i, after - before, np.inf)
+    flat = np.argmin(gain)
+    return gain.flat[flat], flat // (n - 1) + 1, flat % (n - 1) + 1
+
+
+def _best_or_opt(distance_matrix, permutation, max_segment=3):
+    """
+    Best move taking a segment of up to max_segment tracks (never the first one) and inserting it after another
+    position. Returns the gain (negative is better), the segment start, its length and the insertion position
+    """
+    n = len(permutation)
+    result = (np.inf, 0, 0, 0)
+    j = np.arange(n)[np.newaxis, :]
+    j_next = np.minimum(j + 1, n - 1)
+    j_has_next = j < n - 1
+    for length in range(1, min(max_segment, n - 2) + 1):
+        i = np.arange(1, n - length + 1)[:, np.newaxis]
+        first, last = permutation[i], permutation[i + length - 1]
+        after = np.minimum(i + length, n - 1)
+        has_after = i + length < n
+        removal = (distance_matrix[permutation[i - 1], first]
+                   + np.where(has_after, distance_matrix[last, permutation[after]], 0)
+                   - np.where(has_after, distance_matrix[permutation[i - 1], permutation[after]], 0))
+        insertion = (distance_matrix[permutation[j], first]
+                     + np.where(j_has_next, distance_matrix[last, permutation[j_next]], 0)
+                     - np.where(j_has_next, distance_matrix[permutation[j], permutation[j_next]], 0))
+        gain = insertion - removal
+        gain = np.where((j >= i - 1) & (j <= i + length - 1), np.inf, gain)
+        flat = np.argmin(gain)
+        if gain.flat[flat] < result[0]:
+            result = (gain.flat[flat], flat // n + 1, length, flat % n)
+    return result
+
+
+def local_search(distance_matrix, permutation, deadline=None):
+    """
+    Improves a path with best-improvement 2-opt and Or-opt moves until no move improves it, keeping its first track
+    :param distance_matrix: NxN distance matrix, possibly asymmetric
+    :param permutation: Initial order of the tracks
+    :param deadline: Optional time.perf_counter() value at which the search stops
+    :return: The improved permutation as an integer array
+    """
+    permutation = np.array(permutation, dtype=np.int64)
+    if len(permutation) < 3:
+        return permutation
+    while not _expired(deadline):
+        two_opt_gain, i, k = _best_two_opt(distance_matrix, permutation)
+        or_opt_gain, start, length, position = _best_or_opt(distance_matrix, permutation)
+        if min(two_opt_gain, or_opt_gain) > -_IMPROVEMENT_TOLERANCE:
+            break
+        if two_opt_gain <= or_opt_gain:
+            permutation[i:k + 1] = permutation[i:k + 1][::-1]
+        else:
+            segment = permutation[start:start + length]
+            rest = np.concatenate((permutation[:start], permutation[start + length:]))
+            position = position if position < start else position - length
+            permutation = np.concatenate((rest[:position + 1], segment, rest[position + 1:]))
+    return permutation
+
+
+def _perturb(permutation, rng):
+    """
+    Double bridge kick on the tracks after the first one
+    """
+    n = len(permutation)
+    if n < 5:
+        return np.concatenate((permutation[:1], rng.permutation(permutation[1:])))
+    a, b, c = np.sort(rng.choice(np.arange(2, n), size=3, replace=False))
+    return np.concatenate((permutation[:1], permutation[c:], permutation[b:c], permutation[a:b], permutation[1:a]))
+
+
+def solve_heuristic(distance_matrix, start=0, time_budget=DEFAULT_TIME_BUDGET, restarts=50, seed=None,
+                    initial=None):
+    """
+    Good open path for large playlists: 2-opt and Or-opt local search from a nearest neighbour path, restarted from
+    perturbations of the best path found until the time budget or the number of restarts run out.
+    :param distance_matrix: NxN distance matrix, possibly asymmetric
+    :param start: First track of the path, or None to let the solver choose it
+    :param time_budget: Time limit in seconds, or None for no limit
+    :param restarts: Maximum number of restarts after the first descent
+    :param seed: Seed of the random perturbations
+    :param initial: Optional initial permutation, starting with start, used instead of the nearest neighbour path
+    :return: A tuple with the permutation (list starting with start) and its distance
+    """
+    if start is None:
+        return _with_free_start(solve_heuristic, distance_matrix, time_budget=time_budget, restarts=restarts,
+                                seed=seed)
+    deadline = _deadline(time_budget)
+    distance_matrix = np.asarray(distance_matrix, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+
+    if initial is None:
+        initial = nearest_neighbour(distance_matrix, start)
+    elif initial[0] != start:
+        raise ValueError("The initial permutation must begin with the start track")
+    best = local_search(distance_matrix, initial, deadline)
+    best_distance = path_distance(distance_matrix, best)
+    for _ in range(restarts):
+        if _expired(deadline) or len(best) < 4:
+            break
+        candidate = local_search(distance_matrix, _perturb(best, rng), deadline)
+        candidate_distance = path_distance(distance_matrix, candidate)
+        if candidate_distance < best_distance - _IMPROVEMENT_TOLERANCE:
+            best, best_distance = candidate, candidate_distance
+    return [int(i) for i in best], best_distance
+
+
+def insert_cheapest(distance_matrix, permutation, start=0):
+    """
+    Completes a partial path by inserting each missing track where it adds the least distance, the tracks that
+    are not in the matrix any more are dropped. Used to repair the previous order of an edited playlist
+    :param distance_matrix: NxN distance matrix
+    :param permutation: Partial order of the tracks (indices of distance_matrix)
+    :param start: First track of the path, moved to the front if needed
+    :return: The complete permutation as an integer array, starting with start
+    """
+    n = len(distance_matrix)
+    seen = set()
+    path = [start]
+    for i in permutation:
+        if 0 <= i < n and i != start and i not in seen:
+            path.append(int(i))
+        seen.add(i)
+    missing = [i for i in range(n) if i not in seen and i != start]
+    for i in missing:
+        nodes = np.array(path)
+        # Inserting i after position p: d(p, i) + d(i, p + 1) - d(p, p + 1), or just d(p, i) at the end
+        cost = distance_matrix[nodes, i]
+        cost[:-1] += distance_matrix[i, nodes[1:]] - distance_matrix[nodes[:-1], nodes[1:]]
+        position = int(np.argmin(cost))
+        path.insert(position + 1, i)
+    return np.array(path, dtype=np.int64)
+
+
+def solve_incremental(distance_matrix, permutation, start=0, time_budget=None, restarts=0, seed=None):
+    """
+    Sequences an edited playlist starting from the order of its previous version: the previous order is repaired
+    with cheapest insertion and improved with local search, instead of solving from scratch
+    :param distance_matrix: NxN distance matrix of the edited playlist
+    :param permutation: Previous order of the tracks, as indices of distance_matrix. Removed tracks may be omitted
+    :param start: First track of the path
+    :param time_budget: Optional time limit in seconds
+    :param restarts: Perturbation restarts after the local search, 0 for a single descent
+    :param seed: Seed of the perturbations
+    :return: A tuple with the permutation (list starting with start) and its distance
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype=np.float64)
+    initial = insert_cheapest(distance_matrix, permutation, start)
+    return solve_heuristic(distance_matrix, start=start, time_budget=time_budget, restarts=restarts, seed=seed,
+                           initial=initial)
+
+
+def solve(distance_matrix, start=0, time_budget=None, seed=None):
+    """
+    Sequences a playlist choosing the solver by its size:
+        - up to EXACT_MAX_TRACKS tracks, exact Held-Karp. It gets EXACT_BUDGET_SHARE of the time budget, and is
+          skipped when its estimated time does not fit in it. If it runs out of time the heuristic is used instead
+          with the rest of the budget
+        - up to LOCAL_SEARCH_MAX_TRACKS tracks, 2-opt/Or-opt local search with restarts
+        - above, a single local search descent from the nearest neighbour path
+    :param distance_matrix: NxN distance matrix. The first column does not need to be zeroed, the path is open
+    :param start: First track of the path, or None to let the solver choose it
+    :param time_budget: Optional time limit in seconds. The heuristics use DEFAULT_TIME_BUDGET when it is None
+    :param seed: Seed of the heuristic perturbations
+    :return: A tuple with the permutation (list) and its distance, as python_tsp solvers do
+    """
+    n = len(distance_matrix)
+    deadline = _deadline(time_budget)
+    exact_budget = None if time_budget is None else time_budget * EXACT_BUDGET_SHARE
+    # With a free start the solver adds a dummy track
+    exact_tracks = n + 1 if start is None else n
+    if n <= EXACT_MAX_TRACKS and (exact_budget is None or held_karp_seconds(exact_tracks) <= exact_budget):
+        try:
+            return solve_exact(distance_matrix, start=start, time_budget=exact_budget)
+        except TimeoutError:
+            pass
+    remaining = DEFAULT_TIME_BUDGET if deadline is None else max(deadline - time.perf_counter(), 0)
+    restarts = 50 if n <= LOCAL_SEARCH_MAX_TRACKS else 0
+    return solve_heuristic(distance_matrix, start=start, time_budget=remaining, restarts=restarts, seed=seed)
@@ -0,0 +1,224 @@
+"""
+Batched Spotify track metadata with a persistent local cache.
+
+SpotifyCatalog resolves many uris with the tracks endpoint (up to 50 ids per request), backs off when the API rate
+limits it and appends every resolved track to a jsonl cache, so each track is requested once across runs. Any object
+with the tracks(ids) method of spotipy.Spotify can be used as client, e.g. OfflineSpotify when there is no network.
+"""
+import json
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+try:
+    from spotipy import SpotifyException
+except ImportError:  # only OfflineSpotify can be used
+    class SpotifyException(Exception):
+        def __init__(self, http_status, code, msg, reason=None, headers=None):
+            super().__init__(f'http status: {http_status}, code: {code} - {msg}')
+            self.http_status = http_status
+            self.code = code
+            self.msg = msg
+            self.reason = reason
+            self.headers = headers or {}
+
+# Maximum number of ids accepted by the tracks endpoint
+BATCH_SIZE = 50
+# Metadata kept in the cache for each track
+TRACK_FIELDS = ('uri', 'name', 'artists', 'album', 'duration_ms', 'preview_url')
+# Retries of a request that is rate limited or fails on the server side
+MAX_RETRIES = 5
+# Seconds waited before the first retry when the API does not send Retry-After, doubled on each retry
+BACKOFF = 1.0
+
+
+def track_id(uri):
+    """
+    Spotify id of a track uri ('spotify:track:<id>'), ids are returned unchanged
+    """
+    return uri.rsplit(':', 1)[-1]
+
+
+def _slim(track):
+    # Keeps the cached metadata small, the full track object lists ~180 available markets
+    return {'uri': track['uri'],
+            'name': track.get('name'),
+            'artists': [artist['name'] for artist in track.get('artists', [])],
+            'album': track.get('album', {}).get('name'),
+            'duration_ms': track.get('duration_ms'),
+            'preview_url': track.get('preview_url')}
+
+
+def client_from_credentials(client_id, client_secret):
+    """
+    spotipy client with the client credentials flow (no user)
+    """
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+    manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
+    return spotipy.Spotify(client_credentials_manager=manager)
+
+
+class SpotifyCatalog:
+    """
+    Track metadata by uri, fetched in batches and cached on disk. Tracks that Spotify does not know (or whose id is
+    not valid) are cached as None, so they are not requested again either
+    """
+    def __init__(self, client, cache_path=None, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, sleep=time.sleep):
+        """
+        :param client: spotipy.Spotify, or any object with its tracks(ids) method
+        :param cache_path: jsonl file of the persistent cache, None to only cache in memory
+        :param batch_size: Ids per request, at most BATCH_SIZE
+        :param max_retries: Retries of a rate limited or failed request before raising
+        :param sleep: Function used to wait between retries
+        """
+        self.client = client
+        self.cache_path = cache_path
+        self.batch_size = min(batch_size, BATCH_SIZE)
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.n_requests = 0
+        self._tracks = {}
+        self._lock = threading.Lock()
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._tracks[entry['uri']] = entry['track']
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __contains__(self, uri):
+        return uri in self._tracks
+
+    def _request(self, ids):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.n_requests += 1
+                return self.client.tracks(ids)['tracks']
+            except SpotifyException as e:
+                status = e.http_status
+                if attempt == self.max_retries or not (status == 429 or (status is not None and status >= 500)):
+                    raise
+                retry_after = (e.headers or {}).get('Retry-After')
+                self.sleep(float(retry_after) if retry_after is not None else BACKOFF * 2 ** attempt)
+
+    def _fetch(self, uris):
+        """
+        Metadata of a batch of uris. A batch with an invalid id is rejected as a whole (400), so it is split in
+        halves until the invalid ids are isolated
+        """
+        try:
+            tracks = self._request([track_id(uri) for uri in uris])
+        except SpotifyException as e:
+            if e.http_status not in (400, 404):
+                raise
+            if len(uris) == 1:
+                return [None]
+            half = len(uris) // 2
+            return self._fetch(uris[:half]) + self._fetch(uris[half:])
+        return [_slim(track) if track is not None else None for track in tracks]
+
+    def _store(self, uris, tracks):
+        with self._lock:
+            if self.cache_path is not None:
+                with open(self.cache_path, 'a') as f:
+                    for uri, track in zip(uris, tracks):
+                        f.write(json.dumps({'uri': uri, 'track': track}, ensure_ascii=False) + '\n')
+            self._tracks.update(zip(uris, tracks))
+
+    def tracks(self, uris, progress=None):
+        """
+        Metadata of many tracks, only the ones that are not cached are requested
+        :param uris: List of track uris
+        :param progress: Optional wrapper of the iterable of batches, e.g. tqdm
+        :return: List with a dict of TRACK_FIELDS per uri, or None for the tracks that Spotify does not have
+        """
+        missing = [uri for uri in dict.fromkeys(uris) if uri not in self._tracks]
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        for batch in (progress(batches) if progress is not None else batches):
+            self._store(batch, self._fetch(batch))
+        return [self._tracks[uri] for uri in uris]
+
+    def preview_urls(self, uris):
+        """
+        Preview url of each track, None when the track has no preview
+        """
+        return [track['preview_url'] if track is not None else None for track in self.tracks(uris)]
+
+    def available(self, uris):
+        """
+        Whether each track exists and has an audio preview
+        """
+        return [url is not None for url in self.preview_urls(uris)]
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_previews(previews_dir, host='127.0.0.1', port=0):
+    """
+    Serves the files of a directory over HTTP from a daemon thread, so their urls can be fetched with requests
+    :param previews_dir: Directory to serve
+    :param host: Interface to listen on
+    :param port: Port, 0 for any free one
+    :return: The running http.server.ThreadingHTTPServer, its base url is server.url. Stop it with shutdown()
+    """
+    server = ThreadingHTTPServer((host, port), partial(_QuietHandler, directory=os.path.abspath(previews_dir)))
+    server.url = f'http://{host}:{server.server_address[1]}/'
+    threading.Thread(target=server.serve_forever, daemon=True, name='previews-server').start()
+    return server
+
+
+class OfflineSpotify:
+    """
+    Offline stand-in for spotipy.Spotify, for tests and for running without credentials. It knows the given tracks
+    and the tracks with an mp3 in previews_dir, whose preview url is preview_base_url + '<uri>.mp3'
+    """
+    def __init__(self, tracks=None, previews_dir=None, preview_base_url=None):
+        """
+        :param tracks: Dict of track objects by uri
+        :param previews_dir: Directory with '<uri>.mp3' previews, as downloaded by spotify_data_preparation.ipynb
+        :param preview_base_url: Base of the preview urls of previews_dir, e.g. of a server that already serves it.
+        By default previews_dir is served by a local server (see serve_previews), stopped with close()
+        """
+        self.server = None
+        self._tracks = {track_id(uri): dict(track, uri=uri) for uri, track in (tracks or {}).items()}
+        if previews_dir is not None:
+            if preview_base_url is None:
+                self.server = serve_previews(previews_dir)
+                preview_base_url = self.server.url
+            for filename in os.listdir(previews_dir):
+                uri, extension = os.path.splitext(filename)
+                if extension == '.mp3':
+                    url = preview_base_url + quote(filename)
+                    self._tracks.setdefault(track_id(uri), {'uri': uri, 'preview_url': url})
+
+    def close(self):
+        """
+        Stops the local preview server, if any
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def track(self, track_id_or_uri):
+        track = self._tracks.get(track_id(track_id_or_uri))
+        if track is None:
+            raise SpotifyException(404, -1, f'non existing id {track_id_or_uri}', headers={})
+        return track
+
+    def tracks(self, tracks):
+        if len(tracks) > BATCH_SIZE:
+            raise ValueError(f"At most {BATCH_SIZE} ids per request")
+        return {'tracks': [self._tracks.get(track_id(uri)) for uri in tracks]}